@@ -0,0 +1,434 @@
+"""
+Offline end-to-end benchmark for the bot.
+
+Starts a fake HLS origin (synthetic segments with configurable size, latency and bandwidth) and a
+fake Bot API (getMe, getFile, sendMessage, editMessageText, sendVideo, sendDocument with configurable
+upload speed and RetryAfter injection), then drives whole batch files through handle_document ->
+process_video_links exactly like a real user would. At the end it prints videos/hour, bytes/sec and
+per-stage latency from the bot's own metrics, so engines and concurrency settings can be compared
+with reproducible numbers.
+
+Example:
+    python benchmark.py --videos 10 --segments 20 --segment-kb 512 --origin-kbps 4096 \
+        --upload-kbps 2048 --engine hls --download-workers 3 --retry-after-every 7
+
+Note: synthetic segments are MPEG-TS null packets. The yt-dlp engines just concatenate them, but
+the native HLS engine's ffmpeg remux needs real media, so pass --segment-file with a real .ts
+segment when benchmarking DOWNLOAD_ENGINE=hls.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+
+# Bot ki settings import ke time env se padhi jati hain, isliye main ko import karne se pehle set karo
+ENV_OPTIONS = {
+    "engine": "DOWNLOAD_ENGINE",
+    "download_workers": "DOWNLOAD_WORKERS",
+    "upload_workers": "UPLOAD_WORKERS",
+    "queue_size": "PIPELINE_QUEUE_SIZE",
+    "global_download_slots": "GLOBAL_DOWNLOAD_SLOTS",
+    "global_upload_slots": "GLOBAL_UPLOAD_SLOTS",
+    "segment_concurrency": "HLS_SEGMENT_CONCURRENCY",
+    "status_edit_interval": "STATUS_EDIT_INTERVAL",
+}
+
+TS_PACKET_SIZE = 188
+TS_NULL_PACKET = b"\x47\x1f\xff\x10" + b"\xff" * (TS_PACKET_SIZE - 4)
+BENCH_TOKEN = "123456:benchmark"
+BENCH_GROUP_CHAT_ID = "-1001000000001"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark with a fake HLS origin and fake Bot API.")
+    batch = parser.add_argument_group("batch")
+    batch.add_argument("--batches", type=int, default=1, help="Batch files to send, each from a different user.")
+    batch.add_argument("--videos", type=int, default=5, help="Video lines per batch file.")
+
+    origin = parser.add_argument_group("fake HLS origin")
+    origin.add_argument("--segments", type=int, default=10, help="Segments per video.")
+    origin.add_argument("--segment-kb", type=int, default=256, help="Size of each synthetic segment in KiB.")
+    origin.add_argument("--segment-duration", type=float, default=6.0, help="#EXTINF duration of each segment.")
+    origin.add_argument("--segment-file", help="Serve this real .ts file as every segment instead of synthetic data.")
+    origin.add_argument("--origin-latency-ms", type=float, default=20, help="Delay before each response.")
+    origin.add_argument("--origin-kbps", type=float, default=0, help="Per-connection bandwidth in KiB/s (0 = unlimited).")
+    origin.add_argument("--origin-error-every", type=int, default=0,
+                        help="Answer every Nth segment request with 503 (0 = never), to exercise retries.")
+    origin.add_argument("--origin-outage", metavar="START:SECONDS",
+                        help="Answer all segment requests with 503 for SECONDS, starting START seconds into the run.")
+
+    api = parser.add_argument_group("fake Bot API")
+    api.add_argument("--api-latency-ms", type=float, default=30, help="Delay before each Bot API response.")
+    api.add_argument("--upload-kbps", type=float, default=0, help="sendVideo upload speed in KiB/s (0 = unlimited).")
+    api.add_argument("--retry-after-every", type=int, default=0,
+                     help="Answer every Nth call of the --retry-after-methods with 429 RetryAfter (0 = never).")
+    api.add_argument("--retry-after-seconds", type=int, default=1)
+    api.add_argument("--retry-after-methods", default="sendVideo,editMessageText")
+
+    bot = parser.add_argument_group("bot settings (override the env variables)")
+    bot.add_argument("--engine", choices=["yt-dlp", "yt-dlp-api", "hls"])
+    bot.add_argument("--download-workers", type=int)
+    bot.add_argument("--upload-workers", type=int)
+    bot.add_argument("--queue-size", type=int)
+    bot.add_argument("--global-download-slots", type=int)
+    bot.add_argument("--global-upload-slots", type=int)
+    bot.add_argument("--segment-concurrency", type=int)
+    bot.add_argument("--status-edit-interval", type=float, default=1)
+    bot.add_argument("--streaming-upload", action="store_true", help="Set STREAMING_UPLOAD=1.")
+
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the bot's INFO logs.")
+    return parser.parse_args(argv)
+
+
+def apply_bot_env(args):
+    for option, env_name in ENV_OPTIONS.items():
+        value = getattr(args, option)
+        if value is not None:
+            os.environ[env_name] = str(value)
+    if args.streaming_upload:
+        os.environ["STREAMING_UPLOAD"] = "1"
+    os.environ["FILE_ID_CACHE_MAX_ENTRIES"] = "0" # Har run fresh ho, cache hits numbers bigaad denge
+    os.environ["DISK_MIN_FREE_MB"] = os.environ.get("DISK_MIN_FREE_MB", "0")
+
+
+def listen_on_free_port(web_app):
+    """Starts a tornado app on 127.0.0.1 with an OS-assigned port and returns (server, port)."""
+    import tornado.httpserver
+    import tornado.netutil
+
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+    server = tornado.httpserver.HTTPServer(web_app, max_body_size=1 << 40, max_buffer_size=1 << 26)
+    server.add_sockets(sockets)
+    return server, sockets[0].getsockname()[1]
+
+
+async def write_throttled(handler, payload, bytes_per_second):
+    """Writes payload in chunks, sleeping between them so the connection runs at bytes_per_second."""
+    chunk_size = 64 * 1024
+    for start in range(0, len(payload), chunk_size):
+        chunk = payload[start:start + chunk_size]
+        handler.write(chunk)
+        await handler.flush()
+        if bytes_per_second:
+            await asyncio.sleep(len(chunk) / bytes_per_second)
+
+
+def build_origin_app(args, stats):
+    """Fake CDN: /v/<n>/index.m3u8 plus /v/<n>/<i>.ts segments."""
+    import tornado.web
+
+    if args.segment_file:
+        with open(args.segment_file, 'rb') as f:
+            segment = f.read()
+    else:
+        packets = max(1, args.segment_kb * 1024 // TS_PACKET_SIZE)
+        segment = TS_NULL_PACKET * packets
+    latency = args.origin_latency_ms / 1000
+    bandwidth = args.origin_kbps * 1024
+    outage_start, outage_seconds = map(float, args.origin_outage.split(":")) if args.origin_outage else (0, 0)
+    started_at = time.monotonic()
+
+    def should_fail():
+        stats["origin_requests"] += 1
+        if args.origin_error_every and stats["origin_requests"] % args.origin_error_every == 0:
+            return True
+        return outage_start <= time.monotonic() - started_at < outage_start + outage_seconds
+
+    class PlaylistHandler(tornado.web.RequestHandler):
+        async def get(self, video_id):
+            await asyncio.sleep(latency)
+            lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(args.segment_duration + 0.999)}",
+                     "#EXT-X-MEDIA-SEQUENCE:0"]
+            for i in range(args.segments):
+                lines += [f"#EXTINF:{args.segment_duration:.3f},", f"{i}.ts"]
+            lines.append("#EXT-X-ENDLIST")
+            self.set_header("Content-Type", "application/vnd.apple.mpegurl")
+            self.write("\n".join(lines) + "\n")
+
+    class SegmentHandler(tornado.web.RequestHandler):
+        async def get(self, video_id, index):
+            if int(index) >= args.segments:
+                raise tornado.web.HTTPError(404)
+            await asyncio.sleep(latency)
+            if should_fail():
+                stats["origin_errors"] += 1
+                raise tornado.web.HTTPError(503)
+            self.set_header("Content-Type", "video/mp2t")
+            self.set_header("Content-Length", str(len(segment)))
+            await write_throttled(self, segment, bandwidth)
+            stats["origin_bytes"] += len(segment)
+
+    return tornado.web.Application([
+        (r"/v/(\w+)/index\.m3u8", PlaylistHandler),
+        (r"/v/(\w+)/(\d+)\.ts", SegmentHandler),
+    ]), len(segment)
+
+
+def build_bot_api_app(args, stats, batch_files):
+    """Fake Bot API with just the methods the bot uses. batch_files maps file_id -> batch text."""
+    import tornado.web
+
+    latency = args.api_latency_ms / 1000
+    upload_speed = args.upload_kbps * 1024
+    retry_methods = set(filter(None, args.retry_after_methods.split(",")))
+    state = {"message_id": 0}
+
+    def next_message(chat_id, **extra):
+        state["message_id"] += 1
+        chat_type = "private" if not str(chat_id).startswith("-") else "supergroup"
+        return {"message_id": state["message_id"], "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": chat_type}, **extra}
+
+    def should_flood_limit(method):
+        stats["api_calls"][method] = stats["api_calls"].get(method, 0) + 1
+        if not args.retry_after_every or method not in retry_methods:
+            return False
+        counter_key = f"{method}_calls"
+        stats[counter_key] = stats.get(counter_key, 0) + 1
+        return stats[counter_key] % args.retry_after_every == 0
+
+    def flood_response(handler, method):
+        stats["retry_after_injected"] += 1
+        handler.set_status(429)
+        handler.write({"ok": False, "error_code": 429,
+                       "description": f"Too Many Requests: retry after {args.retry_after_seconds}",
+                       "parameters": {"retry_after": args.retry_after_seconds}})
+
+    class MethodHandler(tornado.web.RequestHandler):
+        async def post(self, method):
+            await asyncio.sleep(latency)
+            if should_flood_limit(method):
+                return flood_response(self, method)
+            chat_id = self.get_body_argument("chat_id", BENCH_GROUP_CHAT_ID)
+            if method == "getMe":
+                result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif method == "getFile":
+                file_id = self.get_body_argument("file_id")
+                if file_id not in batch_files:
+                    self.set_status(400)
+                    return self.write({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"})
+                result = {"file_id": file_id, "file_unique_id": file_id,
+                          "file_size": len(batch_files[file_id]), "file_path": f"documents/{file_id}.txt"}
+            elif method == "sendMessage":
+                result = next_message(chat_id, text=self.get_body_argument("text", ""))
+            elif method == "editMessageText":
+                result = next_message(chat_id, text=self.get_body_argument("text", ""))
+                result["message_id"] = int(self.get_body_argument("message_id", result["message_id"]))
+            else:
+                result = True
+            self.write({"ok": True, "result": result})
+
+    @tornado.web.stream_request_body
+    class UploadHandler(tornado.web.RequestHandler):
+        """sendVideo/sendDocument: reads the multipart body at the configured upload speed."""
+        def prepare(self):
+            self.received = 0
+
+        async def data_received(self, chunk):
+            self.received += len(chunk)
+            if upload_speed:
+                await asyncio.sleep(len(chunk) / upload_speed)
+
+        async def post(self, method):
+            await asyncio.sleep(latency)
+            stats["upload_bytes"] += self.received
+            if should_flood_limit(method):
+                return flood_response(self, method)
+            file_id = f"bench-{method}-{state['message_id'] + 1}"
+            media = {"file_id": file_id, "file_unique_id": file_id, "file_size": self.received}
+            if method == "sendVideo":
+                result = next_message(BENCH_GROUP_CHAT_ID, video={**media, "width": 1280, "height": 720, "duration": 0})
+            else:
+                result = next_message(BENCH_GROUP_CHAT_ID, document=media)
+            self.write({"ok": True, "result": result})
+
+    class FileHandler(tornado.web.RequestHandler):
+        def get(self, file_id):
+            if file_id not in batch_files:
+                raise tornado.web.HTTPError(404)
+            self.write(batch_files[file_id])
+
+    return tornado.web.Application([
+        (r"/bot[^/]+/(sendVideo|sendDocument)", UploadHandler),
+        (r"/bot[^/]+/(\w+)", MethodHandler),
+        (r"/file/bot[^/]+/documents/([\w-]+)\.txt", FileHandler),
+    ])
+
+
+def make_document_update(update_id, user_id, file_id, file_name, file_size):
+    """Update payload for a user sending a .txt batch file to the bot in a private chat."""
+    user = {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "document": {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name,
+                         "mime_type": "text/plain", "file_size": file_size},
+        },
+    }
+
+
+def histogram_summary(histogram, label_key, label_value):
+    """count, mean and bucket-based p50/p95 upper bounds for one label of a main.Histogram."""
+    state = histogram.values.get(((label_key, label_value),))
+    if not state or not state[-1]:
+        return None
+    count = state[-1]
+
+    def quantile_bound(q):
+        for bound, bucket_count in zip(histogram.buckets, state):
+            if bucket_count >= q * count:
+                return bound
+        return float("inf")
+
+    return {"count": count, "mean": state[-2] / count, "p50_le": quantile_bound(0.5), "p95_le": quantile_bound(0.95)}
+
+
+def build_report(args, main, stats, wall_seconds, segment_size):
+    stages = sorted({dict(key)["stage"] for key in main.STAGE_DURATION.values})
+    uploaded = main.VIDEOS_PROCESSED.values.get((("result", "uploaded"),), 0)
+    retried = main.VIDEOS_PROCESSED.values.get((("result", "retry"),), 0)
+    failed = main.VIDEOS_PROCESSED.values.get((("result", "failed"),), 0)
+    downloaded_bytes = main.STAGE_BYTES.values.get((("stage", "download"),), 0)
+    uploaded_bytes = main.STAGE_BYTES.values.get((("stage", "upload"),), 0)
+    return {
+        "settings": {
+            "engine": main.DOWNLOAD_ENGINE,
+            "download_workers": main.DOWNLOAD_WORKERS,
+            "upload_workers": main.UPLOAD_WORKERS,
+            "queue_size": main.PIPELINE_QUEUE_SIZE,
+            "global_download_slots": main.GLOBAL_DOWNLOAD_SLOTS,
+            "global_upload_slots": main.GLOBAL_UPLOAD_SLOTS,
+            "streaming_upload": main.STREAMING_UPLOAD,
+            "batches": args.batches,
+            "videos_per_batch": args.videos,
+            "video_bytes": segment_size * args.segments,
+        },
+        "wall_seconds": wall_seconds,
+        "videos_uploaded": uploaded,
+        "videos_failed": failed,
+        "videos_retried": retried,
+        "videos_per_hour": uploaded * 3600 / wall_seconds if wall_seconds else 0,
+        "download_bytes_per_second": downloaded_bytes / wall_seconds if wall_seconds else 0,
+        "upload_bytes_per_second": uploaded_bytes / wall_seconds if wall_seconds else 0,
+        "stages": {stage: {**histogram_summary(main.STAGE_DURATION, "stage", stage),
+                           "throughput": histogram_summary(main.STAGE_THROUGHPUT, "stage", stage)}
+                   for stage in stages},
+        "failures": {",".join(f"{k}={v}" for k, v in key): value for key, value in main.STAGE_FAILURES.values.items()},
+        "telegram_retries": sum(main.TELEGRAM_RETRIES.values.values()),
+        "download_retries": sum(main.DOWNLOAD_RETRY_COUNT.values.values()),
+        "fake_api": stats,
+    }
+
+
+def print_report(report):
+    settings = report["settings"]
+    print(f"\nEngine {settings['engine']}: {settings['batches']} batch(es) x {settings['videos_per_batch']} videos "
+          f"of {settings['video_bytes'] / 1e6:.1f} MB, download workers {settings['download_workers']}, "
+          f"upload workers {settings['upload_workers']}, streaming upload {settings['streaming_upload']}")
+    print(f"Wall time:        {report['wall_seconds']:.2f}s")
+    print(f"Videos:           {report['videos_uploaded']} uploaded, {report['videos_failed']} failed, "
+          f"{report['videos_retried']} retried at the end of the batch")
+    print(f"Videos/hour:      {report['videos_per_hour']:.1f}")
+    print(f"Download:         {report['download_bytes_per_second'] / 1e6:.2f} MB/s")
+    print(f"Upload:           {report['upload_bytes_per_second'] / 1e6:.2f} MB/s")
+    print(f"RetryAfter:       {report['fake_api']['retry_after_injected']} injected, "
+          f"{report['telegram_retries']} seen by the bot")
+    print(f"Origin errors:    {report['fake_api']['origin_errors']} injected, "
+          f"{report['download_retries']} request retries by the native HLS engine")
+    print(f"\n{'stage':<14}{'count':>7}{'mean s':>10}{'p50 <= s':>10}{'p95 <= s':>10}{'mean MB/s':>11}")
+    for stage, summary in report["stages"].items():
+        throughput = summary["throughput"]
+        mb_per_second = f"{throughput['mean'] / 1e6:.2f}" if throughput else "-"
+        print(f"{stage:<14}{summary['count']:>7}{summary['mean']:>10.3f}{summary['p50_le']:>10}"
+              f"{summary['p95_le']:>10}{mb_per_second:>11}")
+    if report["failures"]:
+        print("\nFailures:")
+        for labels, count in report["failures"].items():
+            print(f"  {labels}: {count}")
+
+
+async def run_benchmark(args, main):
+    from telegram import Update
+    from telegram.ext import Application, MessageHandler, filters
+
+    stats = {"origin_requests": 0, "origin_errors": 0, "origin_bytes": 0, "upload_bytes": 0,
+             "retry_after_injected": 0, "api_calls": {}}
+    batch_files = {}
+
+    origin_app, segment_size = build_origin_app(args, stats)
+    origin_server, origin_port = listen_on_free_port(origin_app)
+    api_server, api_port = listen_on_free_port(build_bot_api_app(args, stats, batch_files))
+
+    for b in range(args.batches):
+        lines = [f"Lecture {b + 1}-{v + 1}: http://127.0.0.1:{origin_port}/v/b{b}v{v}/index.m3u8"
+                 for v in range(args.videos)]
+        batch_files[f"batch{b}"] = "\n".join(lines) + "\n"
+
+    application = (
+        Application.builder()
+        .token(BENCH_TOKEN)
+        .base_url(f"http://127.0.0.1:{api_port}/bot")
+        .base_file_url(f"http://127.0.0.1:{api_port}/file/bot")
+        .request(main.build_control_request())
+        .build()
+    )
+    application.add_handler(MessageHandler(filters.Document.ALL, main.handle_document))
+    # Bot ki tarah uploads alag pool se jaate hain; fake API yahan "local Bot API server" ki jagah hai
+    main.upload_bot = main.build_upload_bot(BENCH_TOKEN, f"http://127.0.0.1:{api_port}")
+
+    async with application:
+        await main.upload_bot.initialize()
+        await application.start()
+        start = time.monotonic()
+        jobs = []
+        for b in range(args.batches):
+            file_id = f"batch{b}"
+            payload = make_document_update(b + 1, 1000 + b, file_id, f"bench_{b}.txt", len(batch_files[file_id]))
+            await application.process_update(Update.de_json(payload, application.bot))
+            jobs.extend(job for job in main.active_jobs.values() if job not in jobs)
+        await asyncio.gather(*(job.task for job in jobs if job.task), return_exceptions=True)
+        await main.notice_sender.drain()
+        wall_seconds = time.monotonic() - start
+        await application.stop()
+    await main.close_http_client(application)
+    origin_server.stop()
+    api_server.stop()
+    return build_report(args, main, stats, wall_seconds, segment_size)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    apply_bot_env(args)
+    work_dir = tempfile.mkdtemp(prefix="bot-benchmark-")
+    os.environ["JOB_DB_PATH"] = os.path.join(work_dir, "jobs.db")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main # Settings ab env se load honge
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    main.GROUP_CHAT_ID = BENCH_GROUP_CHAT_ID
+    main.job_store = main.JobStore(os.environ["JOB_DB_PATH"])
+
+    # Bot 'downloads/' relative path use karta hai, isliye benchmark temp directory mein chalta hai
+    os.chdir(work_dir)
+    report = asyncio.run(run_benchmark(args, main))
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main_cli()
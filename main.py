@@ -1,26 +1,188 @@
 import os
 import re
 import asyncio
+import glob
+import hashlib
+import json
 import logging
+import math
+import random
+import shutil
+import signal
+import sqlite3
+import struct
 import subprocess
+import threading
 import time
-from telegram import Update, Bot
+from collections import OrderedDict, deque
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+import httpx
+from telegram import Bot, Message, Update
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 from pathvalidate import sanitize_filename
 
+try:
+    import yt_dlp # Only needed for DOWNLOAD_ENGINE=yt-dlp-api
+except ImportError:
+    yt_dlp = None
+
+try:
+    import tornado.web # Comes with python-telegram-bot[webhooks]; serves the webhook and /metrics
+except ImportError:
+    tornado = None
+
+try:
+    import h2 # Only needed for BOT_API_HTTP2 / UPLOAD_HTTP2 (`pip install httpx[http2]`)
+except ImportError:
+    h2 = None
+
 # Logging setup
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx har segment request ko INFO par log karta hai, jo logs bhar deta hai
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # --- Environment Variables (Render.com par set karna hai) ---
 TELEGRAM_BOT_TOKEN = os.getenv("8219496647:AAG2Oua0cG_2f1lRvI9_6dn61KyH0KXHj-U")
 GROUP_CHAT_ID = os.getenv("-1002827212331") # Yeh woh group ID hai jahan updates aur videos bhejega bot.
 
-# Global dictionary to store cancellation events for ongoing processes.
-# Key: chat_id, Value: asyncio.Event
-cancellation_events = {}
+# Global dictionary of running jobs (one per submitted .txt file).
+# Key: job id, Value: Job
+active_jobs = {}
+# Set while the bot stops for a redeploy: interrupted downloads keep their partial files to resume from
+shutting_down = False
+
+# --- Pipeline Settings ---
+# Ek job ke kitne videos ek saath download honge.
+DOWNLOAD_WORKERS = max(1, int(os.getenv("DOWNLOAD_WORKERS", "2")))
+# Kitne upload workers chalenge. Group mein videos file order mein hi post hote hain,
+# isliye send_video ek samay mein ek hi chalta hai; extra workers sirf agle video ko tayyar rakhte hain.
+UPLOAD_WORKERS = max(1, int(os.getenv("UPLOAD_WORKERS", "1")))
+# Download aur upload ke beech bounded queue ka size. Isse disk par ek saath padi files limit mein rehti hain.
+PIPELINE_QUEUE_SIZE = max(1, int(os.getenv("PIPELINE_QUEUE_SIZE", "2")))
+# Saare jobs milakar kitne downloads aur uploads ek saath chal sakte hain. Slots users ke beech
+# round-robin mein baante jaate hain.
+GLOBAL_DOWNLOAD_SLOTS = max(1, int(os.getenv("GLOBAL_DOWNLOAD_SLOTS", "3")))
+GLOBAL_UPLOAD_SLOTS = max(1, int(os.getenv("GLOBAL_UPLOAD_SLOTS", "2")))
+
+# --- Disk Budget Settings ---
+# downloads/ ke liye max jagah (MB). 0 = koi apni limit nahi, sirf disk ki free space dekhi jayegi.
+DISK_BUDGET_MB = int(os.getenv("DISK_BUDGET_MB", "0"))
+# Disk par hamesha itni jagah khali rehni chahiye (MB).
+DISK_MIN_FREE_MB = int(os.getenv("DISK_MIN_FREE_MB", "500"))
+# Download shuru karne se pehle ek video ke liye itni jagah reserve hoti hai (MB).
+DISK_VIDEO_ESTIMATE_MB = int(os.getenv("DISK_VIDEO_ESTIMATE_MB", "700"))
+# Fail hui lines ke adhure downloads retry pass ke liye max itne MB tak rakhe jaate hain, baaki hata diye jaate hain.
+DISK_RETRY_KEEP_MB = int(os.getenv("DISK_RETRY_KEEP_MB", "1000"))
+# "1" = video ko disk se chunks mein stream karke upload karo, poori file memory mein load kiye bina.
+STREAMING_UPLOAD = os.getenv("STREAMING_UPLOAD", "0") == "1"
+
+# --- Download Engine Settings ---
+# "yt-dlp" (default, har video ke liye yt-dlp command), "yt-dlp-api" (yt_dlp Python API thread pool mein)
+# ya "hls" (in-process parallel segment downloader).
+# "hls" engine kisi video par fail ho to us video ke liye yt-dlp par fallback hota hai.
+DOWNLOAD_ENGINE = os.getenv("DOWNLOAD_ENGINE", "yt-dlp").strip().lower()
+# Native HLS engine ek video ke kitne segments ek saath download karega.
+HLS_SEGMENT_CONCURRENCY = max(1, int(os.getenv("HLS_SEGMENT_CONCURRENCY", "8")))
+YT_DLP_FORMAT = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
+YT_DLP_PROGRESS_PATTERN = re.compile(r'\[download\]\s+(\d+\.\d+)% of (.*?) at (.*?) ETA (.*)')
+# Threads for the "yt-dlp-api" engine (one per concurrent download)
+yt_dlp_executor = ThreadPoolExecutor(max_workers=GLOBAL_DOWNLOAD_SLOTS, thread_name_prefix="yt-dlp")
+# /cancel par yt-dlp/ffmpeg ko SIGTERM ke baad itne seconds milte hain, phir SIGKILL
+CANCEL_KILL_GRACE = float(os.getenv("CANCEL_KILL_GRACE", "1.5"))
+
+# --- Video Post-processing Settings ---
+# Download ke baad ffprobe se width/height/duration nikalna aur zarurat ho to faststart remux
+# (moov atom shuru mein, taaki Telegram mein video turant chalne lage). ffmpeg/ffprobe na ho to skip.
+VIDEO_POSTPROCESS = os.getenv("VIDEO_POSTPROCESS", "1") == "1"
+# send_video ke saath ek JPEG thumbnail bhi bhejna (Telegram limit: 320px, 200 KB)
+VIDEO_THUMBNAILS = os.getenv("VIDEO_THUMBNAILS", "1") == "1"
+
+# --- Bot API Connection Settings ---
+# Control calls (status edits, messages, getFile) aur video uploads alag connection pools use karte hain,
+# taaki 20 minute ka upload status updates ko pool timeout mein na atkaye.
+BOT_API_POOL_SIZE = max(1, int(os.getenv("BOT_API_POOL_SIZE", "8")))
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "10"))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "15"))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", "15"))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "5"))
+BOT_API_HTTP2 = os.getenv("BOT_API_HTTP2", "0") == "1" # h2 package chahiye
+# Upload pool: default har upload slot ke liye ek connection
+UPLOAD_POOL_SIZE = max(1, int(os.getenv("UPLOAD_POOL_SIZE", str(GLOBAL_UPLOAD_SLOTS))))
+UPLOAD_CONNECT_TIMEOUT = float(os.getenv("UPLOAD_CONNECT_TIMEOUT", "30"))
+UPLOAD_READ_TIMEOUT = float(os.getenv("UPLOAD_READ_TIMEOUT", "1200"))
+UPLOAD_WRITE_TIMEOUT = float(os.getenv("UPLOAD_WRITE_TIMEOUT", "1200"))
+UPLOAD_POOL_TIMEOUT = float(os.getenv("UPLOAD_POOL_TIMEOUT", "60"))
+UPLOAD_HTTP2 = os.getenv("UPLOAD_HTTP2", "0") == "1"
+# Self-hosted Bot API server (jaise http://localhost:8081) par uploads bhejna: 2000 MB tak ki files.
+# Updates aur control calls cloud Bot API se hi chalte hain.
+LOCAL_BOT_API_URL = os.getenv("LOCAL_BOT_API_URL", "").rstrip("/")
+# "1" = local server isi machine ki files padh sakta hai; video upload karne ki jagah sirf path bheja jata hai
+BOT_API_LOCAL_MODE = os.getenv("BOT_API_LOCAL_MODE", "0") == "1"
+
+# --- Upload Size Settings ---
+# Bot API ki upload limit (cloud Bot API: 50 MB, local Bot API server: 2000 MB). m3u8 links ke liye isme fit hone wala best variant
+# download se pehle hi chuna jata hai, taaki poora download karke upload fail na ho.
+UPLOAD_SIZE_LIMIT_MB = int(os.getenv("UPLOAD_SIZE_LIMIT_MB", "2000" if LOCAL_BOT_API_URL else "50"))
+# Ek video ke upload ka target time (seconds). Ab tak ki upload speed se jo variant isse zyada lega,
+# uski jagah chhota variant chuna jata hai. 0 = off
+TARGET_UPLOAD_SECONDS = float(os.getenv("TARGET_UPLOAD_SECONDS", "0"))
+# Koi variant limit mein fit na ho to video ko stream-copy karke parts mein todna (1), warna line fail (0)
+SPLIT_OVERSIZED_VIDEOS = os.getenv("SPLIT_OVERSIZED_VIDEOS", "0") == "1"
+
+# --- Retry Settings ---
+# Har segment/fragment (aur playlist/HTTP request) transient error par kitni baar retry hoga.
+# Retries ke beech exponential backoff (RETRY_BACKOFF_BASE se RETRY_BACKOFF_MAX seconds tak) + jitter.
+DOWNLOAD_RETRIES = max(0, int(os.getenv("DOWNLOAD_RETRIES", "10")))
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "1"))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "30"))
+# Batch ke end mein failed lines ko kitni baar dobara try karna hai (adhura download wahin se resume hota hai).
+# 0 = fail hote hi report karo.
+BATCH_RETRY_PASSES = max(0, int(os.getenv("BATCH_RETRY_PASSES", "1")))
+# Upload par Telegram ka RetryAfter (flood control) kitni baar wait karke retry karna hai
+UPLOAD_FLOOD_RETRIES = max(0, int(os.getenv("UPLOAD_FLOOD_RETRIES", "5")))
+
+# --- Job Store Settings ---
+# SQLite file jismein har batch aur line ka state save hota hai. Render par isse persistent disk par rakhein,
+# warna redeploy par yeh bhi mit jayega.
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.db")
+# Itne din purane finished batches startup par DB se hata diye jaate hain.
+JOB_STORE_RETENTION_DAYS = int(os.getenv("JOB_STORE_RETENTION_DAYS", "7"))
+# Shutdown par running jobs ko rukne (aur files/status sambhalne) ke liye itne seconds milte hain
+JOB_STOP_TIMEOUT = float(os.getenv("JOB_STOP_TIMEOUT", "10"))
+# Opened in main()
+job_store = None
+
+# --- File ID Cache Settings ---
+# Bheje gaye videos ka Telegram file_id (URL aur content hash ke hisaab se) save hota hai, taaki
+# dobara wahi video aaye to bina download/upload ke turant bheja ja sake. 0 = cache band.
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv("FILE_ID_CACHE_MAX_ENTRIES", "20000"))
+FILE_ID_CACHE_MAX_AGE_DAYS = int(os.getenv("FILE_ID_CACHE_MAX_AGE_DAYS", "365"))
+# Query parameters that only sign/expire a URL and don't change which video it points to
+URL_SIGNING_PARAMS = {"token", "expires", "expiry", "exp", "signature", "sig", "policy", "key-pair-id",
+                      "hdnts", "hmac", "st", "e", "auth", "auth_key"}
+# Opened in main() (None when disabled)
+file_id_cache = None
+
+# --- Status Message Settings ---
+# Ek chat mein do status edits ke beech kam se kam itne seconds (Telegram group flood limit ~20/min).
+STATUS_EDIT_INTERVAL = float(os.getenv("STATUS_EDIT_INTERVAL", "3"))
+
+# Shared HTTP client (connection pool) for the native HLS engine. Created lazily.
+http_client = None
+# Bot for media uploads only (own connection pool and timeouts, maybe a local Bot API server); set in main()
+upload_bot = None
+upload_http_client = None
 
 # --- Helper Functions ---
 
@@ -34,41 +196,1673 @@ def create_progress_bar(percentage):
     bar = f"[`{'▓' * filled_blocks}{'░' * empty_blocks}`]"
     return f"{bar} {percentage:.1f}%"
 
-async def read_yt_dlp_stderr_for_progress(stream, progress_callback, cancellation_event):
+@dataclass
+class VideoItem:
+    """A single valid line of the .txt file, ready for the download/upload pipeline."""
+    seq: int # Position among valid lines (posting order)
+    video_num: int # 1-based number among the unique valid links of the .txt file
+    raw_title: str
+    video_url: str
+    output_filepath: str
+    state: str = "queued" # Job store line state: queued / downloaded / uploaded / failed
+    cached_file_id: str = None # Telegram file_id if this video was sent before
+    content_hash: str = None # sha256 of the downloaded file (only when the file_id cache is enabled)
+    metadata: "VideoMetadata" = None # Probed after download (None if ffprobe isn't available)
+    thumbnail_path: str = None
+    plan: "DownloadPlan" = None # Variant choice from the pre-flight, kept so that retries resume the same file
+    parts: list = None # VideoParts, if the video had to be split to fit the upload limit
+    parts_uploaded: int = 0 # Parts already posted (checkpointed), so retries and restarts don't post them twice
+
+class PostingTurn:
+    """
+    Makes upload workers post videos in file order, even if downloads finish out of order.
+    Every item must call advance() exactly once, whether it was sent, failed or skipped.
+    """
+    def __init__(self):
+        self._next_seq = 0
+        self._condition = asyncio.Condition()
+
+    async def wait(self, seq):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._next_seq == seq)
+
+    async def advance(self):
+        async with self._condition:
+            self._next_seq += 1
+            self._condition.notify_all()
+
+async def read_yt_dlp_output_for_progress(stream, progress_callback, cancellation_event, output_tail=None):
     """
-    Reads stderr from yt-dlp process to extract progress and call a callback.
+    Reads one output stream of the yt-dlp process to the end, extracting progress and calling a callback.
+    yt-dlp prints progress on stdout and errors on stderr, so one reader runs per stream. The stream is
+    always drained completely (even after cancellation) so that yt-dlp never blocks on a full pipe.
+    If output_tail (a deque) is given, the last lines are kept in it for error messages.
     """
-    last_update_time = time.time()
     while True:
         line = await stream.readline()
         if not line:
             break
-        if cancellation_event.is_set():
-            logger.info("Cancellation requested, stopping stderr reader.")
-            break
 
         line_str = line.decode(errors='ignore').strip()
-        
-        # Regex to parse download progress from yt-dlp stderr
+        if output_tail is not None and line_str:
+            output_tail.append(line_str)
+        if cancellation_event.is_set(): # Stop updates if cancelled, but keep draining
+            continue
+
         # Example: [download] 99.9% of 123.45MiB at 1.23MiB/s ETA 00:01
-        progress_match = re.search(r'\[download\]\s+(\d+\.\d+)% of (.*?) at (.*?) ETA (.*)', line_str)
+        progress_match = YT_DLP_PROGRESS_PATTERN.search(line_str)
         if progress_match:
             percent = float(progress_match.group(1))
-            size = progress_match.group(2)
-            speed = progress_match.group(3)
-            eta = progress_match.group(4)
-            
-            # Update only if enough time has passed to avoid rate limits
-            if time.time() - last_update_time >= 3 or percent >= 99.9: # Update every 3 seconds or when nearly complete
-                await progress_callback(percent, speed, eta)
-                last_update_time = time.time()
-        
+            speed = progress_match.group(3).strip()
+            eta = progress_match.group(4).strip()
+            # Rate limiting is done by StatusMessage, which only keeps the latest text
+            await progress_callback(percent, speed, eta)
+
         # Check for "already downloaded" message
         elif "has already been downloaded" in line_str:
             await progress_callback(100.0, "", "") # Assume 100% if already downloaded
-            break # No more progress updates needed
 
-    logger.info("Stderr reader finished.")
+def backoff_delay(attempt):
+    """
+    Wait before retry number `attempt` (1, 2, ...): exponential, capped at RETRY_BACKOFF_MAX, with half
+    of it random so that many failed segments don't all hit the origin again at the same moment.
+    """
+    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+async def terminate_process(process, grace=CANCEL_KILL_GRACE):
+    """
+    Stops a child process started with start_new_session=True: SIGTERM to its whole process group
+    (yt-dlp may have spawned ffmpeg), then SIGKILL if it hasn't exited within `grace` seconds.
+    """
+    if process.returncode is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        await asyncio.wait_for(process.wait(), timeout=grace)
+    except ProcessLookupError:
+        return
+    except asyncio.TimeoutError:
+        logger.warning(f"Process {process.pid} did not exit after SIGTERM, killing it")
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+def partial_download_paths(output_filepath):
+    """
+    A video's output file and the engines' temp files next to it: .part, .segments, -Frag...,
+    thumbnails and split parts, and yt-dlp's per-format files (`name.f137.mp4.part`) before merging.
+    """
+    stem = glob.escape(os.path.splitext(output_filepath)[0])
+    return set(glob.glob(glob.escape(output_filepath) + "*")) | set(glob.glob(stem + ".f*"))
+
+def remove_partial_download(output_filepath):
+    """Removes a video's output file and the engines' temp files next to it."""
+    for path in partial_download_paths(output_filepath):
+        try:
+            os.remove(path)
+            logger.info(f"Cleaned up {path}")
+        except OSError as e:
+            logger.warning(f"Could not remove partial download {path}: {e}")
+
+# --- Metrics ---
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+class Counter:
+    """Prometheus-style counter with labels."""
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {} # sorted label tuple -> value
+        metrics_registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{format_metric_labels(key)} {value}" for key, value in self.values.items()]
+
+class Gauge(Counter):
+    """Prometheus-style gauge (a counter that can also go down or be set)."""
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram:
+    """Prometheus-style histogram with labels and fixed buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        self.values = {} # sorted label tuple -> [bucket counts..., sum, count]
+        metrics_registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        state = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def render(self):
+        lines = []
+        for key, state in self.values.items():
+            for bound, count in zip(self.buckets, state):
+                lines.append(f"{self.name}_bucket{format_metric_labels(key + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{format_metric_labels(key + (('le', '+Inf'),))} {state[-1]}")
+            lines.append(f"{self.name}_sum{format_metric_labels(key)} {state[-2]}")
+            lines.append(f"{self.name}_count{format_metric_labels(key)} {state[-1]}")
+        return lines
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+metrics_registry = []
+
+STAGE_DURATION = Histogram(
+    "bot_stage_duration_seconds", "Time spent in each processing stage.",
+    [0.05, 0.25, 1, 5, 15, 60, 180, 600, 1800, 3600]
+)
+STAGE_BYTES = Counter("bot_stage_bytes_total", "Bytes moved by the download and upload stages.")
+STAGE_THROUGHPUT = Histogram(
+    "bot_stage_throughput_bytes_per_second", "Per-video throughput of the download and upload stages.",
+    [64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6]
+)
+STAGE_FAILURES = Counter("bot_stage_failures_total", "Failed stage runs by exception type.")
+TELEGRAM_RETRIES = Counter("bot_telegram_retries_total", "RetryAfter (flood control) responses from Telegram.")
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Items waiting in pipeline queues and slot pools.")
+VIDEOS_PROCESSED = Counter("bot_videos_total", "Videos finished, by result.")
+DOWNLOAD_RETRY_COUNT = Counter("bot_download_retries_total", "Playlist/segment requests retried after transient errors.")
+
+@contextmanager
+def track_stage(stage, num_bytes=None):
+    """
+    Times a stage and counts its failures. num_bytes may be a callable returning the bytes moved,
+    evaluated after the stage succeeds (e.g. the size of the downloaded file).
+    """
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        STAGE_FAILURES.inc(stage=stage, error_type=type(e).__name__)
+        raise
+    else:
+        if num_bytes is not None:
+            moved = num_bytes() if callable(num_bytes) else num_bytes
+            STAGE_BYTES.inc(moved, stage=stage)
+            STAGE_THROUGHPUT.observe(moved / max(time.monotonic() - start, 1e-6), stage=stage)
+    finally:
+        STAGE_DURATION.observe(time.monotonic() - start, stage=stage)
+
+
+# --- Native HLS Engine ---
+
+HLS_ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+class HlsUnsupportedError(Exception):
+    """Raised when a playlist uses a feature the native HLS engine can't handle (yt-dlp is used instead)."""
+
+@dataclass
+class HlsVariant:
+    url: str
+    bandwidth: int
+    resolution: str
+    audio_group: str
+    average_bandwidth: int = 0 # AVERAGE-BANDWIDTH (0 if the playlist doesn't give it)
+
+@dataclass
+class HlsPlaylist:
+    variants: list # HlsVariant list (only for master playlists)
+    segment_urls: list
+    segment_durations: list
+    init_url: str = None # EXT-X-MAP init section (fMP4 playlists)
+    separate_audio_groups: frozenset = frozenset() # AUDIO groups which have their own playlist URI
+
+def parse_hls_attributes(attribute_list):
+    """Parses an HLS attribute list like `BANDWIDTH=800000,CODECS="a,b"` into a dict."""
+    return {key: value.strip('"') for key, value in HLS_ATTRIBUTE_PATTERN.findall(attribute_list)}
+
+def parse_hls_playlist(text, base_url, strict=True):
+    """
+    Parses a master or media m3u8 playlist. Relative URIs are resolved against base_url.
+    strict raises HlsUnsupportedError for what the native engine can't download (encryption, byte
+    ranges); the pre-flight only needs variants and durations and parses with strict=False.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or not lines[0].startswith("#EXTM3U"):
+        raise HlsUnsupportedError("Not an m3u8 playlist")
+
+    playlist = HlsPlaylist(variants=[], segment_urls=[], segment_durations=[])
+    audio_groups = set()
+    pending_variant = None
+    pending_duration = None
+    for line in lines[1:]:
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            pending_variant = parse_hls_attributes(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MEDIA:"):
+            attributes = parse_hls_attributes(line.split(":", 1)[1])
+            if attributes.get("TYPE") == "AUDIO" and attributes.get("URI"):
+                audio_groups.add(attributes.get("GROUP-ID", ""))
+        elif line.startswith("#EXTINF:"):
+            pending_duration = float(line.split(":", 1)[1].split(",", 1)[0] or 0)
+        elif line.startswith("#EXT-X-KEY:"):
+            method = parse_hls_attributes(line.split(":", 1)[1]).get("METHOD", "NONE")
+            if method != "NONE" and strict:
+                raise HlsUnsupportedError(f"Encrypted playlist (METHOD={method})")
+        elif line.startswith("#EXT-X-BYTERANGE"):
+            if strict:
+                raise HlsUnsupportedError("Byte-range segments")
+        elif line.startswith("#EXT-X-MAP:"):
+            uri = parse_hls_attributes(line.split(":", 1)[1]).get("URI")
+            if playlist.init_url is not None and uri and strict:
+                raise HlsUnsupportedError("Multiple init sections")
+            playlist.init_url = urljoin(base_url, uri) if uri else None
+        elif line.startswith("#"):
+            continue
+        elif pending_variant is not None:
+            playlist.variants.append(HlsVariant(
+                url=urljoin(base_url, line),
+                bandwidth=int(pending_variant.get("BANDWIDTH", 0) or 0),
+                resolution=pending_variant.get("RESOLUTION", ""),
+                audio_group=pending_variant.get("AUDIO", ""),
+                average_bandwidth=int(pending_variant.get("AVERAGE-BANDWIDTH", 0) or 0),
+            ))
+            pending_variant = None
+        else:
+            playlist.segment_urls.append(urljoin(base_url, line))
+            playlist.segment_durations.append(pending_duration or 0.0)
+            pending_duration = None
+
+    playlist.separate_audio_groups = frozenset(audio_groups)
+    return playlist
+
+def select_hls_variant(variants):
+    """Picks the highest-bandwidth variant, same as yt-dlp's default `best`."""
+    return max(variants, key=lambda variant: variant.bandwidth)
+
+def format_bytes(num_bytes):
+    """Formats a byte count the way yt-dlp does, e.g. `1.23MiB`."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if num_bytes < 1024 or unit == "GiB":
+            return f"{num_bytes:.2f}{unit}"
+        num_bytes /= 1024
+
+def format_eta(seconds):
+    """Formats seconds as `MM:SS` (or `HH:MM:SS`), like yt-dlp's ETA field."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+def get_http_client():
+    """Returns the shared, connection-pooled HTTP client used for HLS playlists and segments."""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_connections=HLS_SEGMENT_CONCURRENCY * GLOBAL_DOWNLOAD_SLOTS,
+                                max_keepalive_connections=HLS_SEGMENT_CONCURRENCY * GLOBAL_DOWNLOAD_SLOTS),
+        )
+    return http_client
+
+def get_upload_http_client():
+    """Returns the HTTP client for streaming uploads, separate from the HLS segment pool."""
+    global upload_http_client
+    if upload_http_client is None or upload_http_client.is_closed:
+        upload_http_client = httpx.AsyncClient(
+            http2=http_version(UPLOAD_HTTP2) == "2",
+            timeout=httpx.Timeout(UPLOAD_CONNECT_TIMEOUT, connect=UPLOAD_CONNECT_TIMEOUT, read=UPLOAD_READ_TIMEOUT,
+                                  write=UPLOAD_WRITE_TIMEOUT, pool=UPLOAD_POOL_TIMEOUT),
+            limits=httpx.Limits(max_connections=UPLOAD_POOL_SIZE, max_keepalive_connections=UPLOAD_POOL_SIZE),
+        )
+    return upload_http_client
+
+async def close_http_client(application: Application) -> None:
+    """post_shutdown hook: closes the shared HTTP clients and the upload bot."""
+    for client in (http_client, upload_http_client):
+        if client is not None and not client.is_closed:
+            await client.aclose()
+    if upload_bot is not None:
+        await upload_bot.shutdown()
+
+def http_version(enabled):
+    """HTTP version for a Bot API backend; falls back to HTTP/1.1 when h2 isn't installed."""
+    if enabled and h2 is None:
+        logger.warning("HTTP/2 ke liye h2 install nahi hai (`pip install httpx[http2]`), HTTP/1.1 use hoga")
+        return "1.1"
+    return "2" if enabled else "1.1"
+
+def build_control_request():
+    """Request backend for the bot's small, frequent calls (messages, status edits, getFile)."""
+    return HTTPXRequest(
+        connection_pool_size=BOT_API_POOL_SIZE,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        read_timeout=BOT_API_READ_TIMEOUT,
+        write_timeout=BOT_API_WRITE_TIMEOUT,
+        pool_timeout=BOT_API_POOL_TIMEOUT,
+        http_version=http_version(BOT_API_HTTP2),
+    )
+
+def build_upload_bot(token, server_url=None):
+    """
+    A second Bot that only sends videos: its own connection pool with long timeouts, so uploads
+    never hold the connections that status updates need. server_url points it at a local Bot API server.
+    """
+    server_kwargs = {}
+    if server_url:
+        server_kwargs = dict(base_url=f"{server_url}/bot", base_file_url=f"{server_url}/file/bot",
+                             local_mode=BOT_API_LOCAL_MODE)
+    return Bot(
+        token,
+        request=HTTPXRequest(
+            connection_pool_size=UPLOAD_POOL_SIZE,
+            connect_timeout=UPLOAD_CONNECT_TIMEOUT,
+            read_timeout=UPLOAD_READ_TIMEOUT,
+            write_timeout=UPLOAD_WRITE_TIMEOUT,
+            pool_timeout=UPLOAD_POOL_TIMEOUT,
+            http_version=http_version(UPLOAD_HTTP2),
+        ),
+        **server_kwargs
+    )
+
+# Status codes worth retrying; other 4xx (403 expired link, 404) won't get better by waiting
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+def is_transient_http_error(error):
+    """Connection problems, timeouts and retryable status codes."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+async def get_with_retries(client, url):
+    """GET with up to DOWNLOAD_RETRIES retries (exponential backoff + jitter) on transient errors."""
+    for attempt in range(1, DOWNLOAD_RETRIES + 2):
+        try:
+            response = await client.get(url)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPError as e:
+            if not is_transient_http_error(e) or attempt > DOWNLOAD_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"GET {url} failed ({e!r}), retry {attempt}/{DOWNLOAD_RETRIES} in {delay:.1f}s")
+            DOWNLOAD_RETRY_COUNT.inc(engine="hls")
+            await asyncio.sleep(delay)
+
+async def resolve_hls_media_playlist(client, playlist_url):
+    """Fetches the playlist and, if it is a master playlist, the chosen variant's media playlist."""
+    with track_stage("resolve"):
+        return await fetch_hls_media_playlist(client, playlist_url)
+
+async def fetch_hls_media_playlist(client, playlist_url):
+    response = await get_with_retries(client, playlist_url)
+    playlist = parse_hls_playlist(response.text, str(response.url))
+    if not playlist.variants:
+        return playlist
+
+    variant = select_hls_variant(playlist.variants)
+    if variant.audio_group and variant.audio_group in playlist.separate_audio_groups:
+        raise HlsUnsupportedError("Audio is in a separate rendition")
+    logger.info(f"HLS variant chosen: {variant.resolution or 'unknown'} @ {variant.bandwidth} bps")
+
+    response = await get_with_retries(client, variant.url)
+    playlist = parse_hls_playlist(response.text, str(response.url))
+    if playlist.variants:
+        raise HlsUnsupportedError("Nested master playlist")
+    return playlist
+
+async def run_media_tool(*command):
+    """Runs ffmpeg/ffprobe and returns its stdout. Raises an exception on failure; killed if cancelled."""
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        await terminate_process(process)
+        raise
+    if process.returncode != 0:
+        raise Exception(f"{command[0]} failed with code {process.returncode}: {stderr.decode(errors='ignore').strip()}")
+    return stdout
+
+async def remux_to_mp4(input_path, output_path):
+    """
+    Stream-copies the input (e.g. concatenated HLS segments) into an mp4 container with ffmpeg,
+    with the moov atom at the front so that Telegram clients can start playing before the download ends.
+    """
+    with track_stage("remux"):
+        await run_media_tool(
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-i", input_path,
+            "-c", "copy", "-bsf:a", "aac_adtstoasc",
+            "-movflags", "+faststart",
+            output_path
+        )
+
+def load_hls_resume_state(state_path, video_url, total_segments):
+    """(segments, bytes) already written by an earlier failed attempt at this video, or (0, 0)."""
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return 0, 0
+    if state.get("url") != video_url or state.get("total_segments") != total_segments:
+        return 0, 0 # Playlist badal gayi, shuru se download karo
+    return state["segments_done"], state["bytes_done"]
+
+def save_hls_resume_state(state_path, video_url, total_segments, segments_done, bytes_done):
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({"url": video_url, "total_segments": total_segments,
+                   "segments_done": segments_done, "bytes_done": bytes_done}, f)
+    os.replace(temp_path, state_path)
+
+async def download_video_with_hls(video_url: str, output_filepath: str, progress_callback,
+                                  cancellation_event: asyncio.Event) -> None:
+    """
+    Downloads an m3u8 video in-process: segments are fetched in parallel over the pooled
+    HTTP client, written in order to one file, and then remuxed to mp4.
+    Each segment is retried with backoff on transient errors. If the download still fails, the
+    segments written so far stay on disk and the next attempt continues after them.
+    Progress is reported with the same (percent, speed, eta) values as the yt-dlp output reader.
+    """
+    if shutil.which("ffmpeg") is None:
+        # Remux ke bina segments kisi kaam ke nahi; poori video download karke fail hone se pehle hi fallback
+        raise HlsUnsupportedError("ffmpeg not found, segments can't be remuxed")
+    client = get_http_client()
+    playlist = await resolve_hls_media_playlist(client, video_url)
+    if not playlist.segment_urls:
+        raise HlsUnsupportedError("Playlist has no segments")
+
+    segment_urls = list(playlist.segment_urls)
+    if playlist.init_url:
+        segment_urls.insert(0, playlist.init_url)
+    total_segments = len(segment_urls)
+
+    segment_slots = asyncio.Semaphore(HLS_SEGMENT_CONCURRENCY)
+
+    async def fetch_segment(segment_url):
+        async with segment_slots:
+            response = await get_with_retries(client, segment_url)
+            return response.content
+
+    concat_path = f"{output_filepath}.segments"
+    state_path = f"{concat_path}.json"
+    segments_done, bytes_done = (0, 0)
+    if os.path.exists(concat_path):
+        segments_done, bytes_done = load_hls_resume_state(state_path, video_url, total_segments)
+        if os.path.getsize(concat_path) < bytes_done:
+            segments_done, bytes_done = (0, 0)
+    if segments_done:
+        logger.info(f"Resuming HLS download of {output_filepath} at segment {segments_done}/{total_segments}")
+
+    pending = deque()
+    start_time = time.time()
+    downloaded_bytes = 0
+    try:
+        with open(concat_path, 'r+b' if segments_done else 'wb') as concat_file:
+            concat_file.truncate(bytes_done) # Aadha likha hua aakhri segment hata do
+            concat_file.seek(bytes_done)
+            next_index = segments_done
+            for written in range(segments_done, total_segments):
+                # Keep a window of segment fetches running ahead of the writer
+                while next_index < total_segments and len(pending) < HLS_SEGMENT_CONCURRENCY * 2:
+                    pending.append(asyncio.create_task(fetch_segment(segment_urls[next_index])))
+                    next_index += 1
+
+                if cancellation_event.is_set():
+                    raise asyncio.CancelledError("HLS download cancelled by user.")
+
+                data = await pending.popleft()
+                concat_file.write(data)
+                concat_file.flush()
+                downloaded_bytes += len(data)
+                bytes_done += len(data)
+
+                done = written + 1
+                save_hls_resume_state(state_path, video_url, total_segments, done, bytes_done)
+                percent = done * 100.0 / total_segments
+                elapsed = max(time.time() - start_time, 1e-6)
+                speed = downloaded_bytes / elapsed
+                eta = (total_segments - done) * (elapsed / (done - segments_done))
+                await progress_callback(percent, f"{format_bytes(speed)}/s", format_eta(eta))
+
+        await remux_to_mp4(concat_path, output_filepath)
+        logger.info(f"Successfully downloaded with native HLS engine: {output_filepath}")
+        for path in (concat_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+    finally:
+        # Failure par .segments file rehne do taaki agla attempt resume kar sake
+        # (cancel hone par download_video use hata deta hai)
+        for task in pending:
+            task.cancel()
+
+
+# --- Download Planning ---
+
+class VideoTooLargeError(Exception):
+    """The video can't be brought under the upload limit (no variant fits and splitting is off or failed)."""
+
+class ThroughputEstimate:
+    """Exponentially weighted average of the upload speed so far, in bytes/s (None until the first upload)."""
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        self.bytes_per_second = None
+
+    def update(self, num_bytes, seconds):
+        if seconds <= 0 or num_bytes < 1024 * 1024:
+            return # Chhote uploads mein latency hi zyada hoti hai, speed ka andaza galat hoga
+        speed = num_bytes / seconds
+        if self.bytes_per_second is None:
+            self.bytes_per_second = speed
+        else:
+            self.bytes_per_second += self.weight * (speed - self.bytes_per_second)
+
+upload_throughput = ThroughputEstimate()
+
+@dataclass
+class DownloadPlan:
+    """What to download for a line, decided before the transfer starts."""
+    url: str # Media playlist of the chosen variant, or the original link
+    yt_dlp_format: str = None # Format for the yt-dlp engines (None = YT_DLP_FORMAT)
+    estimated_bytes: int = None
+    variant: HlsVariant = None
+
+def estimate_variant_bytes(variant, duration):
+    """Size estimate from bitrate x duration (BANDWIDTH is a peak rate, so AVERAGE-BANDWIDTH is preferred)."""
+    return int((variant.average_bandwidth or variant.bandwidth) / 8 * duration)
+
+def choose_hls_variant(variants, duration, size_limit, upload_bytes_per_second, target_seconds, allow_split):
+    """
+    The highest-bandwidth variant whose estimated size fits size_limit (any size if splitting is
+    allowed) and whose estimated upload time fits target_seconds. If the time target can't be met,
+    the smallest variant. Returns (variant, estimated_bytes); raises VideoTooLargeError if nothing fits.
+    """
+    def fits(estimated_bytes, check_time):
+        if not allow_split and estimated_bytes > size_limit:
+            return False
+        if check_time and target_seconds and upload_bytes_per_second:
+            return estimated_bytes / upload_bytes_per_second <= target_seconds
+        return True
+
+    by_quality = sorted(variants, key=lambda variant: variant.bandwidth, reverse=True)
+    for variant in by_quality:
+        estimated_bytes = estimate_variant_bytes(variant, duration)
+        if fits(estimated_bytes, check_time=True):
+            return variant, estimated_bytes
+    smallest = by_quality[-1]
+    estimated_bytes = estimate_variant_bytes(smallest, duration)
+    if fits(estimated_bytes, check_time=False):
+        return smallest, estimated_bytes
+    raise VideoTooLargeError(
+        f"सबसे छोटा वेरिएंट भी अपलोड लिमिट ({UPLOAD_SIZE_LIMIT_MB} MB) से बड़ा है: "
+        f"लगभग {format_bytes(estimated_bytes)}"
+    )
+
+async def plan_download(video_url):
+    """
+    Pre-flight for m3u8 links: reads the master playlist (and one media playlist for the duration),
+    estimates every variant's size and picks the one to download. Links that aren't m3u8, and
+    playlists we can't read, are downloaded as before.
+    """
+    if not urlsplit(video_url).path.endswith(".m3u8"):
+        return DownloadPlan(url=video_url)
+    client = get_http_client()
+    try:
+        with track_stage("preflight"):
+            response = await get_with_retries(client, video_url)
+            # Encrypted (AES-128) lectures bhi: size ka andaza variants/durations se hi lagta hai
+            master = parse_hls_playlist(response.text, str(response.url), strict=False)
+            if not master.variants:
+                return DownloadPlan(url=video_url) # Sirf ek rendition hai, chunne ko kuch nahi
+            # Sabhi variants ki duration same hoti hai, ek media playlist kaafi hai
+            response = await get_with_retries(client, master.variants[0].url)
+            duration = sum(parse_hls_playlist(response.text, str(response.url), strict=False).segment_durations)
+    except (httpx.HTTPError, HlsUnsupportedError) as e:
+        logger.warning(f"Pre-flight for {video_url} failed ({e}), default format use hoga")
+        return DownloadPlan(url=video_url)
+
+    variant, estimated_bytes = choose_hls_variant(
+        master.variants, duration, UPLOAD_SIZE_LIMIT_MB * 1024 * 1024,
+        upload_throughput.bytes_per_second, TARGET_UPLOAD_SECONDS, SPLIT_OVERSIZED_VIDEOS
+    )
+    logger.info(f"Pre-flight {video_url}: {duration:.0f}s, variant {variant.resolution or '?'} @ {variant.bandwidth} bps, "
+                f"~{format_bytes(estimated_bytes)} (of {len(master.variants)} variants)")
+    if variant.audio_group and variant.audio_group in master.separate_audio_groups:
+        # Audio alag playlist mein hai: master hi do, yt-dlp bitrate cap ke saath video+audio jod lega
+        kbps = variant.bandwidth // 1000 + 1
+        return DownloadPlan(url=video_url, yt_dlp_format=f"bv*[tbr<={kbps}]+ba/b[tbr<={kbps}]",
+                            estimated_bytes=estimated_bytes, variant=variant)
+    return DownloadPlan(url=variant.url, estimated_bytes=estimated_bytes, variant=variant)
+
+
+# --- Job Store ---
+
+class JobStore:
+    """
+    SQLite-backed checkpoint of every batch and each of its lines, so that a restart or
+    redeploy can resume unfinished batches without re-sending videos that were already uploaded.
+    Batch states: running / done / cancelled / failed. Line states: queued / downloaded / uploaded / failed.
+    """
+    def __init__(self, db_path):
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        # WAL + NORMAL sync: har line ka checkpoint sasta rehta hai aur crash par bhi DB safe rehta hai
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_name TEXT NOT NULL,
+                status_msg_id INTEGER NOT NULL,
+                total_videos INTEGER NOT NULL,
+                user_id INTEGER,
+                state TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS lines (
+                batch_id INTEGER NOT NULL REFERENCES batches(id) ON DELETE CASCADE,
+                video_num INTEGER NOT NULL,
+                raw_title TEXT NOT NULL,
+                video_url TEXT NOT NULL,
+                output_filepath TEXT NOT NULL,
+                state TEXT NOT NULL,
+                error TEXT,
+                parts_uploaded INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (batch_id, video_num)
+            );
+        """)
+        # DBs created before jobs had owners don't have the user_id column yet
+        batch_columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(batches)")}
+        if "user_id" not in batch_columns:
+            self.connection.execute("ALTER TABLE batches ADD COLUMN user_id INTEGER")
+        # Split videos ke parts ka checkpoint baad mein aaya
+        line_columns = {row["name"] for row in self.connection.execute("PRAGMA table_info(lines)")}
+        if "parts_uploaded" not in line_columns:
+            self.connection.execute("ALTER TABLE lines ADD COLUMN parts_uploaded INTEGER NOT NULL DEFAULT 0")
+        self.connection.commit()
+
+    def create_batch(self, file_name, status_msg_id, total_videos, user_id=None):
+        now = time.time()
+        cursor = self.connection.execute(
+            "INSERT INTO batches (file_name, status_msg_id, total_videos, user_id, state, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'running', ?, ?)",
+            (file_name, status_msg_id, total_videos, user_id, now, now)
+        )
+        self.connection.commit()
+        return cursor.lastrowid
+
+    def set_batch_total(self, batch_id, total_videos):
+        self.connection.execute(
+            "UPDATE batches SET total_videos = ?, updated_at = ? WHERE id = ?", (total_videos, time.time(), batch_id)
+        )
+        self.connection.commit()
+
+    def add_lines(self, batch_id, items):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT INTO lines (batch_id, video_num, raw_title, video_url, output_filepath, state, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(batch_id, item.video_num, item.raw_title, item.video_url, item.output_filepath, item.state, now)
+             for item in items]
+        )
+        self.connection.commit()
+
+    def set_line_state(self, batch_id, video_num, state, error=None):
+        self.connection.execute(
+            "UPDATE lines SET state = ?, error = ?, updated_at = ? WHERE batch_id = ? AND video_num = ?",
+            (state, error, time.time(), batch_id, video_num)
+        )
+        self.connection.commit()
+
+    def set_parts_uploaded(self, batch_id, video_num, parts_uploaded):
+        self.connection.execute(
+            "UPDATE lines SET parts_uploaded = ?, updated_at = ? WHERE batch_id = ? AND video_num = ?",
+            (parts_uploaded, time.time(), batch_id, video_num)
+        )
+        self.connection.commit()
+
+    def finish_batch(self, batch_id, state):
+        self.connection.execute(
+            "UPDATE batches SET state = ?, updated_at = ? WHERE id = ?", (state, time.time(), batch_id)
+        )
+        self.connection.commit()
+
+    def unfinished_batches(self):
+        return self.connection.execute(
+            "SELECT * FROM batches WHERE state = 'running' ORDER BY id"
+        ).fetchall()
+
+    def has_lines(self, batch_id):
+        return self.connection.execute("SELECT 1 FROM lines WHERE batch_id = ? LIMIT 1", (batch_id,)).fetchone() is not None
+
+    def pending_items(self, batch_id):
+        """Returns VideoItems for lines that still need work (queued or downloaded), in file order."""
+        rows = self.connection.execute(
+            "SELECT * FROM lines WHERE batch_id = ? AND state IN ('queued', 'downloaded') ORDER BY video_num",
+            (batch_id,)
+        ).fetchall()
+        return [VideoItem(seq=seq, video_num=row["video_num"], raw_title=row["raw_title"],
+                          video_url=row["video_url"], output_filepath=row["output_filepath"], state=row["state"],
+                          parts_uploaded=row["parts_uploaded"])
+                for seq, row in enumerate(rows)]
+
+    def prune_finished(self, older_than_seconds):
+        """Deletes finished batches (and their lines) older than the given age."""
+        cutoff = time.time() - older_than_seconds
+        self.connection.execute(
+            "DELETE FROM lines WHERE batch_id IN "
+            "(SELECT id FROM batches WHERE state != 'running' AND updated_at < ?)", (cutoff,)
+        )
+        self.connection.execute("DELETE FROM batches WHERE state != 'running' AND updated_at < ?", (cutoff,))
+        self.connection.commit()
+
+
+# --- File ID Cache ---
+
+def normalize_video_url(url):
+    """Normalizes a video URL for cache lookups: lowercase host, no fragment, sorted query without signing params."""
+    parts = urlsplit(url.strip())
+    netloc = (parts.hostname or "").lower()
+    if parts.port and not (parts.scheme == "http" and parts.port == 80) \
+            and not (parts.scheme == "https" and parts.port == 443):
+        netloc += f":{parts.port}"
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if key.lower() not in URL_SIGNING_PARAMS)
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path, urlencode(query), ""))
+
+def hash_file(path):
+    """Returns the sha256 hex digest of a file (run it in a thread for big videos)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FileIdCache:
+    """
+    Persistent map of cache key (`url:<normalized url>` or `sha256:<hex>`) to the Telegram file_id
+    of a video the bot already sent. Entries older than max_age_seconds expire, and the least
+    recently used entries are evicted above max_entries.
+    """
+    def __init__(self, db_path, max_entries, max_age_seconds):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS file_ids (
+                cache_key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used_at);
+        """)
+        self.connection.commit()
+
+    def lookup(self, cache_key):
+        row = self.connection.execute(
+            "SELECT file_id, created_at FROM file_ids WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        file_id, created_at = row
+        now = time.time()
+        if now - created_at > self.max_age_seconds:
+            self.connection.execute("DELETE FROM file_ids WHERE cache_key = ?", (cache_key,))
+            self.connection.commit()
+            return None
+        self.connection.execute("UPDATE file_ids SET last_used_at = ? WHERE cache_key = ?", (now, cache_key))
+        self.connection.commit()
+        return file_id
+
+    def store(self, cache_keys, file_id):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO file_ids (cache_key, file_id, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+            [(cache_key, file_id, now, now) for cache_key in cache_keys]
+        )
+        self.evict()
+
+    def forget(self, file_id):
+        self.connection.execute("DELETE FROM file_ids WHERE file_id = ?", (file_id,))
+        self.connection.commit()
+
+    def evict(self):
+        self.connection.execute("DELETE FROM file_ids WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+        self.connection.execute(
+            "DELETE FROM file_ids WHERE cache_key IN "
+            "(SELECT cache_key FROM file_ids ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+        )
+        self.connection.commit()
+
+
+# --- Status Message Updater ---
+
+class ChatRateLimiter:
+    """Spaces out message edits per chat so status updates stay under Telegram's flood limits."""
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_allowed = {} # chat_id -> monotonic time of the next allowed edit
+        self._locks = {}
+
+    async def wait(self, chat_id):
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            delay = self._next_allowed.get(chat_id, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_allowed[chat_id] = time.monotonic() + self.interval
+
+    def defer(self, chat_id, seconds):
+        """Pushes the next allowed edit back, e.g. after a RetryAfter from Telegram."""
+        self._next_allowed[chat_id] = max(self._next_allowed.get(chat_id, 0), time.monotonic() + seconds)
+
+status_edit_limiter = ChatRateLimiter(STATUS_EDIT_INTERVAL)
+
+class StatusMessage:
+    """
+    Background editor for one status message. set() only records the latest desired text and
+    returns immediately; a background task edits the message, coalescing intermediate texts,
+    skipping identical edits and waiting out RetryAfter without blocking download/upload workers.
+    """
+    def __init__(self, bot, chat_id, message_id, text=""):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._desired_text = text
+        self._sent_text = text
+        self._changed = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    def set(self, text):
+        self._desired_text = text
+        if text != self._sent_text:
+            self._changed.set()
+
+    async def close(self):
+        """Delivers the latest text (if it is not sent yet) and stops the background task."""
+        self._closed = True
+        self._changed.set()
+        await self._task
+
+    async def _run(self):
+        while not (self._closed and self._desired_text == self._sent_text):
+            if self._desired_text == self._sent_text:
+                await self._changed.wait()
+                self._changed.clear()
+                continue
+
+            await status_edit_limiter.wait(self.chat_id)
+            text = self._desired_text # Whatever is latest after waiting for our slot
+            if text == self._sent_text:
+                continue
+            try:
+                with track_stage("status_edit"):
+                    await self.bot.edit_message_text(
+                        chat_id=self.chat_id,
+                        message_id=self.message_id,
+                        text=text,
+                        parse_mode="Markdown"
+                    )
+                self._sent_text = text
+            except RetryAfter as e:
+                logger.warning(f"Status edit flood-limited, retrying after {e.retry_after}s")
+                TELEGRAM_RETRIES.inc(method="editMessageText")
+                status_edit_limiter.defer(self.chat_id, e.retry_after)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    logger.warning(f"Status message update failed: {e}")
+                self._sent_text = text # Retrying the same text won't help
+            except Exception as e:
+                logger.warning(f"Status message update failed: {e}")
+                self._sent_text = text # Drop this text, the next set() will try again
+
+async def send_notice(bot, text, chat_id=None, **kwargs):
+    """
+    Sends a standalone message (per-video errors, restart notices, the job's final reply) to the
+    group or chat_id, waiting out flood limits. Other errors are only logged: a notice must never
+    fail the job it is about.
+    """
+    for flood_retry in range(UPLOAD_FLOOD_RETRIES + 1):
+        try:
+            return await bot.send_message(chat_id=chat_id or GROUP_CHAT_ID, text=text, parse_mode="Markdown", **kwargs)
+        except RetryAfter as e:
+            TELEGRAM_RETRIES.inc(method="sendMessage")
+            logger.warning(f"Notice flood-limited, retrying after {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except TelegramError as e:
+            logger.warning(f"Notice could not be sent: {e}")
+            return None
+    logger.warning(f"Notice dropped after {UPLOAD_FLOOD_RETRIES} flood limits: {text}")
+    return None
+
+class NoticeSender:
+    """
+    Background sender for notices: post() queues the message and returns at once, and one task
+    sends the queue in order with send_notice. A flood-limited notice then never holds up the upload
+    worker (and, through the posting turn, every later line of the job).
+    """
+    def __init__(self):
+        self._queue = deque()
+        self._task = None
+
+    def post(self, bot, text, **kwargs):
+        self._queue.append((bot, text, kwargs))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._queue:
+            bot, text, kwargs = self._queue.popleft()
+            await send_notice(bot, text, **kwargs)
+
+    async def drain(self, timeout=None):
+        """Waits (at most timeout seconds) for the queued notices to go out, e.g. before the bot stops."""
+        if self._task is not None and not self._task.done():
+            await asyncio.wait([self._task], timeout=timeout)
+
+notice_sender = NoticeSender()
+
+async def send_batch_summary(bot, summary, document_path, filename):
+    """
+    Sends a batch file's validation summary with the rejected lines attached, waiting out flood
+    limits. If the document can't be sent, the summary goes out as a plain notice; either way the
+    batch carries on.
+    """
+    for flood_retry in range(UPLOAD_FLOOD_RETRIES + 1):
+        try:
+            with open(document_path, 'rb') as document_file:
+                return await bot.send_document(
+                    chat_id=GROUP_CHAT_ID,
+                    document=document_file,
+                    filename=filename,
+                    caption=summary,
+                    parse_mode="Markdown"
+                )
+        except RetryAfter as e:
+            TELEGRAM_RETRIES.inc(method="sendDocument")
+            logger.warning(f"Batch summary flood-limited, retrying after {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except (TelegramError, OSError) as e:
+            logger.warning(f"Batch summary document could not be sent: {e}")
+            break
+    await send_notice(bot, summary) # Kam se kam ginti to pahunche
+
+
+# --- Disk Budget ---
+
+class DiskBudget:
+    """
+    Delays new downloads until the downloads disk has room for them. Each download reserves an
+    estimated size; the part of a reservation not yet written to disk is counted against the free
+    space, so concurrent downloads can't together overrun the disk.
+    Reservations are granted in the order downloads queued up (see enqueue), so a later, smaller
+    line can't take the room an earlier line is waiting for, and then wait for that line to be posted.
+    """
+    def __init__(self, path, budget_bytes, min_free_bytes, retry_keep_bytes):
+        self.path = path
+        self.budget_bytes = budget_bytes # 0 = no cap of our own, only the real free space counts
+        self.min_free_bytes = min_free_bytes
+        self.retry_keep_bytes = retry_keep_bytes
+        self._reservations = {} # file path -> reserved bytes
+        self._retained = {} # file path -> bytes on disk kept for a retry pass (see retain)
+        self._queue = deque() # file paths waiting for a reservation, in request order
+        self._condition = None
+
+    @staticmethod
+    def _written_bytes(path):
+        written = 0
+        for written_path in partial_download_paths(path): # Engines likhte .part/.segments mein hain
+            try:
+                written += os.path.getsize(written_path)
+            except OSError:
+                pass # Beech mein rename/delete ho gayi
+        return written
+
+    def _unwritten_bytes(self):
+        return sum(max(0, reserved - self._written_bytes(path)) for path, reserved in self._reservations.items())
+
+    def _fits(self, num_bytes):
+        if not self._reservations:
+            return True # Always let one download run, even if the estimate is bigger than the disk
+        used = sum(self._reservations.values()) + sum(self._retained.values())
+        if self.budget_bytes and used + num_bytes > self.budget_bytes:
+            return False
+        disk_path = self.path if os.path.isdir(self.path) else "."
+        free = shutil.disk_usage(disk_path).free - self._unwritten_bytes()
+        return free - num_bytes >= self.min_free_bytes
+
+    def enqueue(self, file_path):
+        """
+        Takes file_path's place in line before its size is known (e.g. before the pre-flight), so
+        downloads are granted in file order even if a later line's pre-flight finishes first.
+        """
+        if file_path not in self._queue and file_path not in self._reservations:
+            self._queue.append(file_path)
+
+    async def acquire(self, file_path, num_bytes, urgent=False):
+        """
+        Waits until file_path is first in line and num_bytes fit on the disk, then reserves them.
+        urgent reserves right away: for a download that lines already holding disk are waiting on,
+        where waiting for them to free it could never end.
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        if urgent:
+            if file_path in self._queue:
+                self._queue.remove(file_path)
+            self._retained.pop(file_path, None)
+            self._reservations[file_path] = num_bytes
+            return
+        self.enqueue(file_path)
+        async with self._condition:
+            try:
+                while True:
+                    if file_path not in self._queue:
+                        # release() ne line se hata diya (download cancel ho raha hai)
+                        raise asyncio.CancelledError("Released while waiting for disk space")
+                    if self._queue[0] == file_path:
+                        if self._fits(num_bytes):
+                            break
+                        logger.info(f"Disk budget full, waiting before downloading {file_path}")
+                    try:
+                        # Free space can also change outside the bot, so re-check periodically
+                        await asyncio.wait_for(self._condition.wait(), timeout=10)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if file_path in self._queue:
+                    self._queue.remove(file_path) # Cancelled: don't block the lines behind us
+                self._condition.notify_all()
+                raise
+            self._queue.popleft()
+            self._retained.pop(file_path, None) # Retry: jo likha ja chuka hai wo ab is reservation mein ginta hai
+            self._reservations[file_path] = num_bytes
+            self._condition.notify_all() # The next in line may fit too
+
+    async def retain(self, file_path):
+        """
+        Swaps file_path's reservation for its size on disk, for a failed line that keeps its partial
+        download until the retry pass. Retained data keeps counting against the budget; returns False
+        (the caller deletes the files) once DISK_RETRY_KEEP_MB of retained data is reached.
+        """
+        size = self._written_bytes(file_path)
+        await self.release(file_path)
+        if sum(self._retained.values()) + size > self.retry_keep_bytes:
+            return False
+        self._retained[file_path] = size
+        return True
+
+    async def release(self, file_path):
+        """Drops the reservation, retained data or place in line of file_path (safe to call more than once)."""
+        self._retained.pop(file_path, None)
+        reserved = self._reservations.pop(file_path, None) is not None
+        queued = file_path in self._queue
+        if queued:
+            self._queue.remove(file_path)
+        if (reserved or queued) and self._condition is not None:
+            async with self._condition:
+                self._condition.notify_all()
+
+disk_budget = DiskBudget("downloads", DISK_BUDGET_MB * 1024 * 1024, DISK_MIN_FREE_MB * 1024 * 1024,
+                         DISK_RETRY_KEEP_MB * 1024 * 1024)
+
+
+# --- Video Post-processing ---
+
+@dataclass
+class VideoMetadata:
+    """What ffprobe tells us about a downloaded video."""
+    format_names: list # e.g. ["mov", "mp4", "m4a", "3gp", "3g2", "mj2"] or ["mpegts"]
+    width: int = None
+    height: int = None
+    duration: int = None # seconds
+
+    def send_video_params(self):
+        """width/height/duration for send_video, leaving out what is unknown."""
+        params = {"width": self.width, "height": self.height, "duration": self.duration}
+        return {key: value for key, value in params.items() if value}
+
+def media_tools_available():
+    return shutil.which("ffprobe") is not None and shutil.which("ffmpeg") is not None
+
+async def probe_video(path):
+    """Runs ffprobe once and returns the container, display size and duration of the video."""
+    output = await run_media_tool(
+        "ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path
+    )
+    info = json.loads(output)
+    metadata = VideoMetadata(format_names=info.get("format", {}).get("format_name", "").split(","))
+    duration = info.get("format", {}).get("duration")
+    if duration:
+        metadata.duration = round(float(duration))
+
+    video_stream = next((stream for stream in info.get("streams", []) if stream.get("codec_type") == "video"), None)
+    if video_stream:
+        metadata.width = video_stream.get("width")
+        metadata.height = video_stream.get("height")
+        # Phone se record hui videos rotation ke saath store hoti hain; Telegram ko dikhne wala size chahiye
+        rotation = video_stream.get("tags", {}).get("rotate")
+        for side_data in video_stream.get("side_data_list", []):
+            rotation = side_data.get("rotation", rotation)
+        if rotation is not None and abs(int(float(rotation))) % 180 == 90:
+            metadata.width, metadata.height = metadata.height, metadata.width
+    return metadata
+
+def mp4_moov_before_mdat(path):
+    """
+    Walks the top-level mp4 boxes: True if the index (moov) comes before the media data (mdat),
+    False if after it (clients must fetch the whole file before playing), None if unreadable.
+    """
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            box_size, box_type = struct.unpack(">I4s", header[:8])
+            if box_size == 1 and len(header) == 16:
+                box_size = struct.unpack(">Q", header[8:16])[0] # 64-bit size
+            elif box_size == 0:
+                box_size = file_size - offset # Box runs to the end of the file
+            if box_size < 8:
+                return None
+            if box_type == b"moov":
+                return True
+            if box_type == b"mdat":
+                return False
+            offset += box_size
+    return None
+
+def needs_faststart_remux(path, metadata):
+    """Remux only if the file isn't really mp4 (e.g. MPEG-TS from HLS) or its moov atom is at the end."""
+    if "mp4" not in metadata.format_names:
+        return True
+    return mp4_moov_before_mdat(path) is False
+
+async def make_thumbnail(path, metadata, thumbnail_path):
+    """Grabs one frame a little into the video as a JPEG of at most 320px, as Telegram wants it."""
+    offset = min(10, metadata.duration * 0.1) if metadata.duration else 0
+    await run_media_tool(
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-ss", f"{offset:.2f}", "-i", path,
+        "-frames:v", "1",
+        "-vf", "scale='if(gt(iw,ih),320,-2)':'if(gt(iw,ih),-2,320)'",
+        "-q:v", "5",
+        thumbnail_path
+    )
+
+async def postprocess_file(path):
+    """
+    Post-download stage: probes the file once, makes it faststart with a stream-copy remux only when
+    needed, and creates a thumbnail. Returns (metadata, thumbnail_path), either of which may be None.
+    Problems here never fail the line: the video is then uploaded as it is, without metadata.
+    """
+    metadata, thumbnail_path = None, None
+    if not VIDEO_POSTPROCESS or not media_tools_available():
+        return metadata, thumbnail_path
+    try:
+        with track_stage("probe"):
+            metadata = await probe_video(path)
+
+        if needs_faststart_remux(path, metadata):
+            logger.info(f"Faststart remux for {path} (format {','.join(metadata.format_names)})")
+            remuxed_path = f"{path}.faststart.mp4"
+            try:
+                await remux_to_mp4(path, remuxed_path)
+                os.replace(remuxed_path, path)
+            finally:
+                if os.path.exists(remuxed_path):
+                    os.remove(remuxed_path)
+            metadata.format_names = ["mp4"]
+
+        if VIDEO_THUMBNAILS and metadata.width:
+            candidate_path = f"{path}.thumb.jpg" # Same prefix, so it is cleaned up with the video
+            with track_stage("thumbnail"):
+                await make_thumbnail(path, metadata, candidate_path)
+            if os.path.exists(candidate_path) and os.path.getsize(candidate_path) <= 200 * 1024:
+                thumbnail_path = candidate_path
+    except Exception as e:
+        logger.warning(f"Post-processing of {path} failed, uploading as is: {e}")
+    return metadata, thumbnail_path
+
+async def postprocess_video(item: VideoItem):
+    """Runs postprocess_file on the item's download and sets item.metadata and item.thumbnail_path."""
+    item.metadata, item.thumbnail_path = await postprocess_file(item.output_filepath)
+
+@dataclass
+class VideoPart:
+    """One stream-copied piece of a video that was too big to upload whole."""
+    path: str
+    metadata: VideoMetadata = None
+    thumbnail_path: str = None
+
+async def split_video(path, metadata, size_limit):
+    """
+    Splits a video into stream-copied (no re-encode) faststart mp4 parts of at most size_limit bytes.
+    ffmpeg can only cut at keyframes, so parts are aimed at 90% of the limit.
+    """
+    size = os.path.getsize(path)
+    if not metadata or not metadata.duration or not media_tools_available():
+        raise VideoTooLargeError(f"वीडियो ({format_bytes(size)}) अपलोड लिमिट ({UPLOAD_SIZE_LIMIT_MB} MB) से बड़ा है "
+                                 "और उसकी अवधि पता नहीं है, इसलिए टुकड़े नहीं हो सके")
+    parts_count = math.ceil(size / (size_limit * 0.9))
+    logger.info(f"Splitting {path} ({format_bytes(size)}) into {parts_count} parts")
+    with track_stage("split"):
+        await run_media_tool(
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-i", path,
+            "-map", "0:v", "-map", "0:a?", "-c", "copy",
+            "-f", "segment", "-segment_time", f"{metadata.duration / parts_count:.2f}",
+            "-reset_timestamps", "1", "-segment_format_options", "movflags=+faststart",
+            f"{path}.part%02d.mp4" # Same prefix, so the parts are cleaned up with the video
+        )
+    part_paths = sorted(glob.glob(glob.escape(path) + ".part[0-9][0-9].mp4"))
+    oversized = [part for part in part_paths if os.path.getsize(part) > size_limit]
+    if not part_paths or oversized:
+        raise VideoTooLargeError(f"वीडियो ({format_bytes(size)}) के टुकड़े अपलोड लिमिट "
+                                 f"({UPLOAD_SIZE_LIMIT_MB} MB) में नहीं आए")
+    parts = []
+    for part_path in part_paths:
+        part_metadata, part_thumbnail = await postprocess_file(part_path)
+        parts.append(VideoPart(part_path, part_metadata, part_thumbnail))
+    return parts
+
+async def fit_upload_limit(item: VideoItem):
+    """
+    Checks the downloaded file against UPLOAD_SIZE_LIMIT_MB. An oversized file is split into
+    item.parts when SPLIT_OVERSIZED_VIDEOS is on; otherwise the line fails with VideoTooLargeError
+    here, before the upload slot is spent on a request Telegram would reject anyway.
+    """
+    size_limit = UPLOAD_SIZE_LIMIT_MB * 1024 * 1024
+    size = os.path.getsize(item.output_filepath)
+    if size <= size_limit or item.parts:
+        return
+    if not SPLIT_OVERSIZED_VIDEOS:
+        raise VideoTooLargeError(f"वीडियो ({format_bytes(size)}) अपलोड लिमिट ({UPLOAD_SIZE_LIMIT_MB} MB) से बड़ा है")
+    item.parts = await split_video(item.output_filepath, item.metadata, size_limit)
+
+
+# --- Video Upload ---
+
+async def send_video_streaming(bot: Bot, chat_id, video_path: str, thumbnail_path: str = None, **params):
+    """
+    Calls sendVideo with the file streamed from disk in chunks. python-telegram-bot's InputFile
+    reads the whole file into memory first, which a multi-GB lecture can't afford.
+    """
+    data = {}
+    for key, value in params.items():
+        if value is None:
+            continue
+        data[key] = str(value).lower() if isinstance(value, bool) else str(value)
+
+    try:
+        with ExitStack() as stack:
+            files = {"video": (os.path.basename(video_path), stack.enter_context(open(video_path, 'rb')), "video/mp4")}
+            if thumbnail_path:
+                # Bot API: thumbnails are sent as their own multipart part and referenced with attach://
+                files["thumbnail"] = ("thumbnail.jpg", stack.enter_context(open(thumbnail_path, 'rb')), "image/jpeg")
+                data["thumbnail"] = "attach://thumbnail"
+            response = await get_upload_http_client().post(
+                f"{bot.base_url}/sendVideo",
+                data={"chat_id": str(chat_id), **data},
+                files=files,
+            )
+        result = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        raise NetworkError(f"Streaming upload failed: {e}") from e
+
+    if not result.get("ok"):
+        description = result.get("description", "Unknown error")
+        retry_after = (result.get("parameters") or {}).get("retry_after")
+        if retry_after is not None:
+            raise RetryAfter(retry_after)
+        if result.get("error_code") == 400:
+            raise BadRequest(description)
+        raise TelegramError(description)
+    return Message.de_json(result["result"], bot)
+
+async def upload_video_file(bot: Bot, video_path: str, caption: str, thumbnail_path: str = None, **video_params):
+    """
+    Sends a downloaded video to the group with the upload bot (falls back to the given bot).
+    A local Bot API server in local mode gets the file path; otherwise the video is streamed
+    from disk when STREAMING_UPLOAD is on.
+    """
+    bot = upload_bot or bot
+    if bot.local_mode:
+        # Server khud disk se padh leta hai, kuch upload nahi hota
+        return await bot.send_video(
+            chat_id=GROUP_CHAT_ID,
+            video=Path(video_path).absolute(),
+            caption=caption,
+            supports_streaming=True,
+            thumbnail=Path(thumbnail_path).absolute() if thumbnail_path else None,
+            read_timeout=UPLOAD_READ_TIMEOUT,
+            write_timeout=UPLOAD_WRITE_TIMEOUT,
+            parse_mode="Markdown",
+            **video_params
+        )
+    if STREAMING_UPLOAD:
+        return await send_video_streaming(
+            bot, GROUP_CHAT_ID, video_path,
+            thumbnail_path=thumbnail_path,
+            caption=caption,
+            supports_streaming=True,
+            parse_mode="Markdown",
+            **video_params
+        )
+    with ExitStack() as stack:
+        video_file = stack.enter_context(open(video_path, 'rb'))
+        thumbnail_file = stack.enter_context(open(thumbnail_path, 'rb')) if thumbnail_path else None
+        return await bot.send_video(
+            chat_id=GROUP_CHAT_ID,
+            video=video_file,
+            caption=caption,
+            supports_streaming=True,
+            thumbnail=thumbnail_file,
+            # Per call dena zaroori hai: files wali requests par PTB warna write_timeout 20s kar deta hai
+            read_timeout=UPLOAD_READ_TIMEOUT,
+            write_timeout=UPLOAD_WRITE_TIMEOUT,
+            parse_mode="Markdown",
+            **video_params
+        )
+
+
+# --- yt-dlp API Engine ---
+
+def run_yt_dlp_api_download(video_url, output_filepath, progress_hook, format_spec=None):
+    """Runs one download with yt_dlp.YoutubeDL (blocking; called in the yt-dlp thread pool)."""
+    retry_sleep = lambda attempt: backoff_delay(attempt + 1) # yt-dlp counts retries from 0
+    options = {
+        "format": format_spec or YT_DLP_FORMAT,
+        "outtmpl": output_filepath,
+        "continuedl": True, # Pichhle attempt ki .part file / fragments se resume
+        "retries": DOWNLOAD_RETRIES,
+        "fragment_retries": DOWNLOAD_RETRIES,
+        "retry_sleep_functions": {"http": retry_sleep, "fragment": retry_sleep},
+        "skip_unavailable_fragments": False,
+        "restrictfilenames": True,
+        "quiet": True,
+        "noprogress": True,
+        "progress_hooks": [progress_hook],
+    }
+    with yt_dlp.YoutubeDL(options) as ydl:
+        return_code = ydl.download([video_url])
+    if return_code != 0:
+        raise Exception(f"yt-dlp failed with code {return_code}")
+
+async def download_video_with_yt_dlp_api(video_url: str, output_filepath: str, progress_callback,
+                                         cancellation_event: asyncio.Event, format_spec: str = None) -> None:
+    """
+    Downloads a single video with the yt-dlp Python API in a worker thread. Progress comes from
+    yt-dlp's progress_hooks as numbers (bytes, speed, ETA) instead of scraped text.
+    """
+    loop = asyncio.get_running_loop()
+    progress_updates = asyncio.Queue()
+    stop_requested = threading.Event() # Set when our task is cancelled; the thread can't be interrupted otherwise
+
+    def progress_hook(progress):
+        # Runs in the worker thread, after every chunk, so a cancel is noticed almost immediately
+        if cancellation_event.is_set() or stop_requested.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Download cancelled by user.")
+        if progress.get("status") == "downloading":
+            loop.call_soon_threadsafe(progress_updates.put_nowait, dict(progress))
+
+    async def forward_progress():
+        while True:
+            progress = await progress_updates.get()
+            downloaded = progress.get("downloaded_bytes") or 0
+            total = progress.get("total_bytes") or progress.get("total_bytes_estimate")
+            if total:
+                percent = min(downloaded * 100.0 / total, 100.0)
+            elif progress.get("fragment_count"):
+                percent = (progress.get("fragment_index") or 0) * 100.0 / progress["fragment_count"]
+            else:
+                continue
+            speed = progress.get("speed")
+            eta = progress.get("eta")
+            await progress_callback(
+                percent,
+                f"{format_bytes(speed)}/s" if speed else "",
+                format_eta(eta) if eta is not None else ""
+            )
+
+    forward_task = asyncio.create_task(forward_progress())
+    download_future = loop.run_in_executor(
+        yt_dlp_executor, run_yt_dlp_api_download, video_url, output_filepath, progress_hook, format_spec
+    )
+    try:
+        await asyncio.shield(download_future)
+    except asyncio.CancelledError:
+        # Let the thread stop writing before the caller deletes the partial file
+        stop_requested.set()
+        await asyncio.wait([download_future], timeout=CANCEL_KILL_GRACE)
+        raise
+    except yt_dlp.utils.DownloadCancelled:
+        raise asyncio.CancelledError("yt-dlp download cancelled by user.")
+    finally:
+        forward_task.cancel()
+
+    logger.info(f"Successfully downloaded with yt-dlp API: {output_filepath}")
+
+
+# --- Batch File Parser ---
+
+# Accepted line formats (date is optional, URL can be any http(s) link, bare URLs are allowed):
+#   Title [08-Apr-2024 08:30]: https://link.m3u8
+#   Title [08-Apr-2024]: https://link.mp4
+#   Title: https://link.m3u8
+#   https://link.m3u8
+BATCH_LINE_PATTERN = re.compile(
+    r"^(?:(?P<title>.*?)\s*(?:\[(?P<date>\d{1,2}-[A-Za-z]{3}-\d{4}(?:\s+\d{1,2}:\d{2})?)\])?\s*:\s*)?"
+    r"(?P<url>https?://\S+)$"
+)
+
+@dataclass
+class BatchFileReport:
+    """Result of parsing a batch .txt file: the unique valid entries plus rejected-line counts."""
+    entries: list # (raw_title, video_url) tuples in file order
+    invalid_count: int = 0
+    duplicate_count: int = 0
+    rejected_path: str = None # Text file listing every rejected line (None if nothing was rejected)
+
+def title_from_url(video_url):
+    """Fallback title for bare-URL lines: the last path component without its extension."""
+    name = os.path.basename(urlsplit(video_url).path)
+    return os.path.splitext(name)[0] or "video"
+
+def parse_batch_file(txt_file_path, rejected_path):
+    """
+    Parses the batch file line by line (without loading it into memory). Invalid lines and
+    duplicate URLs are written to rejected_path instead of being reported one message at a time.
+    """
+    report = BatchFileReport(entries=[])
+    first_line_of_url = {} # normalized URL -> line number where it was first seen
+    rejected_file = None
+    try:
+        with open(txt_file_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+
+                match = BATCH_LINE_PATTERN.match(line)
+                if match:
+                    video_url = match.group("url")
+                    url_key = normalize_video_url(video_url)
+                    if url_key in first_line_of_url:
+                        report.duplicate_count += 1
+                        reason = f"duplicate of line {first_line_of_url[url_key]}"
+                    else:
+                        first_line_of_url[url_key] = line_number
+                        raw_title = (match.group("title") or "").strip() or title_from_url(video_url)
+                        report.entries.append((raw_title, video_url))
+                        continue
+                else:
+                    report.invalid_count += 1
+                    reason = "invalid format"
+
+                if rejected_file is None:
+                    rejected_file = open(rejected_path, 'w', encoding='utf-8')
+                    report.rejected_path = rejected_path
+                rejected_file.write(f"Line {line_number} ({reason}): {line}\n")
+    finally:
+        if rejected_file is not None:
+            rejected_file.close()
+    return report
+
+
+# --- Job Scheduler ---
+
+class FairSlots:
+    """
+    Global pool of slots (e.g. concurrent downloads) shared by all jobs. When slots are scarce,
+    waiting users are served round-robin, so one user's 200-line batch can't starve another's.
+    """
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.in_use = 0
+        self._waiters = OrderedDict() # user key -> deque of futures, in round-robin order
+
+    async def acquire(self, user_key):
+        if self.in_use < self.size and not self._waiters:
+            self.in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user_key, deque()).append(future)
+        QUEUE_DEPTH.inc(queue=f"{self.name}_slots")
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # The slot was granted just as we got cancelled
+            else:
+                queue = self._waiters.get(user_key)
+                if queue and future in queue:
+                    queue.remove(future)
+                    QUEUE_DEPTH.dec(queue=f"{self.name}_slots")
+                    if not queue:
+                        del self._waiters[user_key]
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        while self.in_use < self.size and self._waiters:
+            user_key, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            # Move this user to the back of the line
+            del self._waiters[user_key]
+            if queue:
+                self._waiters[user_key] = queue
+            QUEUE_DEPTH.dec(queue=f"{self.name}_slots")
+            if future.done():
+                continue
+            self.in_use += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_key):
+        await self.acquire(user_key)
+        try:
+            yield
+        finally:
+            self.release()
+
+download_slot_pool = FairSlots("download", GLOBAL_DOWNLOAD_SLOTS)
+upload_slot_pool = FairSlots("upload", GLOBAL_UPLOAD_SLOTS)
+
+@dataclass
+class Job:
+    """One submitted batch file, with its own ID (the job store batch id), status message and cancel handle."""
+    job_id: int
+    file_name: str
+    status: "StatusMessage"
+    user_id: int = None # None for jobs resumed after a restart whose sender is unknown
+    user_name: str = ""
+    cancellation_event: asyncio.Event = field(default_factory=asyncio.Event)
+    total_videos: int = 0
+    processed: int = 0
+    task: asyncio.Task = None
+    inflight_tasks: set = field(default_factory=set) # Downloads/uploads that /cancel aborts right away
+
+    @property
+    def user_key(self):
+        """Key used for round-robin fairness between users."""
+        return self.user_id if self.user_id is not None else f"job-{self.job_id}"
+
+    def track(self, task):
+        """Registers an in-flight download/upload task so that cancel() can abort it."""
+        self.inflight_tasks.add(task)
+        task.add_done_callback(self.inflight_tasks.discard)
+        return task
+
+    def cancel(self):
+        """Stops the job now: no new work starts, and running downloads and uploads are aborted."""
+        self.cancellation_event.set()
+        for task in list(self.inflight_tasks):
+            task.cancel()
+
+class JobCancelledError(asyncio.CancelledError):
+    """An in-flight step of a job was aborted by /cancel (the worker running it was not cancelled)."""
+
+async def run_abortable(job: Job, coro):
+    """Runs coro as a task that job.cancel() can abort mid-way, e.g. a 2 GB upload."""
+    task = job.track(asyncio.create_task(coro))
+    try:
+        await asyncio.wait([task])
+    except asyncio.CancelledError:
+        task.cancel() # We ourselves are being cancelled, don't leave the step running
+        raise
+    if task.cancelled():
+        raise JobCancelledError("Aborted by /cancel")
+    return task.result()
+
+def format_job_list():
+    """One line per active job, for /jobs and /cancel."""
+    lines = []
+    for job in active_jobs.values():
+        # Naam mein _ * [ ho to Markdown parse fail hota hai
+        owner = escape_markdown(job.user_name) if job.user_name else "restart से फिर शुरू"
+        state = " ⛔ रद्द हो रहा है" if job.cancellation_event.is_set() else ""
+        lines.append(f"`#{job.job_id}` `{job.file_name}` — {owner} — {job.processed}/{job.total_videos}{state}")
+    return "\n".join(lines)
 
 
 # --- Bot Command Handlers ---
@@ -78,21 +1872,45 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_text(
         "नमस्ते! मैं एक वीडियो डाउनलोडर बॉट हूँ। मुझे एक .txt file भेजो जिसमें वीडियो लिंक्स हों।"
         "\n\n👉 **File Format:** `Advance - Class-01 | Calculation (Cube & Cube Root) [08-Apr-2024 08:30]: https://link.m3u8`"
+        "\n(तारीख़ वैकल्पिक है: `Title: https://link` या सिर्फ़ `https://link` भी चलेगा)"
         "\n\n**Commands:**"
-        "\n`/cancel` - चल रहे वीडियो डाउनलोड प्रोसेस को रद्द करें।"
+        "\n`/jobs` - चल रहे jobs और उनकी प्रगति देखें।"
+        "\n`/cancel <job id>` - किसी job को रद्द करें (एक ही job चल रहा हो तो सिर्फ़ `/cancel`)।"
     )
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Cancels the ongoing video processing for the current chat."""
-    chat_id = str(GROUP_CHAT_ID) # Use string for consistency with dict keys
+    """Cancels a job: `/cancel <job id>`, or just `/cancel` when only one job is running."""
+    running_jobs = [job for job in active_jobs.values() if not job.cancellation_event.is_set()]
+    job = None
+    if context.args:
+        try:
+            job = active_jobs.get(int(context.args[0].lstrip("#")))
+        except ValueError:
+            job = None
+        if job is None or job.cancellation_event.is_set():
+            await context.bot.send_message(
+                chat_id=GROUP_CHAT_ID,
+                text=f"❌ **Job `{context.args[0]}` नहीं मिला या पहले ही रद्द हो रहा है।** `/jobs` से चल रहे jobs देखें।",
+                parse_mode="Markdown"
+            )
+            return
+    elif len(running_jobs) == 1:
+        job = running_jobs[0]
+    elif len(running_jobs) > 1:
+        await context.bot.send_message(
+            chat_id=GROUP_CHAT_ID,
+            text="कई jobs चल रहे हैं, `/cancel <job id>` से बताएं कौन सा रद्द करना है:\n\n" + format_job_list(),
+            parse_mode="Markdown"
+        )
+        return
 
-    if chat_id in cancellation_events and not cancellation_events[chat_id].is_set():
-        cancellation_events[chat_id].set() # Set the event to signal cancellation
-        logger.info(f"Cancellation requested for chat_id: {chat_id}")
+    if job is not None:
+        job.cancel() # Aborts the running downloads/uploads too, not just the next video
+        logger.info(f"Cancellation requested for job {job.job_id} ({job.file_name})")
         await context.bot.send_message(
             chat_id=GROUP_CHAT_ID,
-            text="✅ **वीडियो डाउनलोड/अपलोड प्रोसेस रद्द करने का अनुरोध स्वीकार किया गया है।** "
-                 "वर्तमान वीडियो को समाप्त करने के बाद अगला प्रोसेस नहीं होगा।",
+            text=f"✅ **Job `#{job.job_id}` (`{job.file_name}`) को रद्द करने का अनुरोध स्वीकार किया गया है।** "
+                 "चल रहे डाउनलोड और अपलोड तुरंत रोके जा रहे हैं।",
             parse_mode="Markdown"
         )
     else:
@@ -102,270 +1920,691 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             parse_mode="Markdown"
         )
 
-async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles incoming .txt documents."""
-    user_id = update.message.from_user.id
-    chat_id = str(GROUP_CHAT_ID) # Ensure we're using the target group ID for processing.
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Lists the running jobs with their IDs and progress."""
+    if active_jobs:
+        await update.message.reply_text("📋 **चल रहे jobs:**\n\n" + format_job_list(), parse_mode="Markdown")
+    else:
+        await update.message.reply_text("कोई job नहीं चल रहा है।")
 
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles incoming .txt documents. Each file becomes its own job that runs in the background."""
     if update.message.document and update.message.document.mime_type == "text/plain":
         document = update.message.document
-        file_id = document.file_id
         file_name = document.file_name
-
-        await update.message.reply_text(f"फ़ाइल मिली: `{file_name}`. लिंक्स प्रोसेस हो रहे हैं...", parse_mode="Markdown")
-
-        # Create a 'downloads' directory if it doesn't exist
-        os.makedirs("downloads", exist_ok=True)
-        local_txt_path = os.path.join("downloads", file_name)
-
-        # Initialize a new cancellation event for this process
-        cancellation_events[chat_id] = asyncio.Event()
+        user = update.message.from_user
 
         initial_group_msg_text = f"🤖 Bot `{file_name}` में वीडियो लिंक्स को प्रोसेस करना शुरू कर रहा है।\n" \
                                   "कृपया प्रतीक्षा करें..."
-        initial_group_msg = None
         try:
             initial_group_msg = await context.bot.send_message(
                 chat_id=GROUP_CHAT_ID,
                 text=initial_group_msg_text,
                 parse_mode="Markdown"
             )
-            initial_group_msg_id = initial_group_msg.message_id
-            
-            # Download the .txt file locally [3, 4, 25, 32, 35]
-            new_file = await context.bot.get_file(file_id)
-            await new_file.download_to_drive(local_txt_path)
-            logger.info(f"Downloaded {file_name} to {local_txt_path}")
-
-            await process_video_links(context, local_txt_path, initial_group_msg_id, cancellation_events[chat_id])
-            
-            if not cancellation_events[chat_id].is_set():
-                await update.message.reply_text("✅ सभी वीडियो सफलतापूर्वक प्रोसेस हो गए हैं!")
-                await context.bot.edit_message_text(
-                    chat_id=GROUP_CHAT_ID,
-                    message_id=initial_group_msg_id,
-                    text=f"🎉 `{file_name}` का प्रोसेसिंग पूरा हुआ! सभी वीडियो इस ग्रुप में भेज दिए गए हैं।",
-                    parse_mode="Markdown"
-                )
-            else:
-                await update.message.reply_text("⛔ वीडियो प्रोसेस रद्द कर दिया गया है।")
-                await context.bot.edit_message_text(
-                    chat_id=GROUP_CHAT_ID,
-                    message_id=initial_group_msg_id,
-                    text=f"⛔ `{file_name}` का प्रोसेसिंग रद्द कर दिया गया है।",
-                    parse_mode="Markdown"
-                )
-
         except Exception as e:
-            logger.error(f"Error processing document {file_name}: {e}", exc_info=True)
+            logger.error(f"Error starting job for {file_name}: {e}", exc_info=True)
             await update.message.reply_text(f"❌ `{file_name}` को प्रोसेस करते समय एक त्रुटि हुई: `{e}`")
-            if initial_group_msg:
-                await context.bot.edit_message_text(
-                    chat_id=GROUP_CHAT_ID,
-                    message_id=initial_group_msg_id,
-                    text=f"❌ `{file_name}` को प्रोसेस करते समय त्रुटि हुई: `{e}`",
-                    parse_mode="Markdown"
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=GROUP_CHAT_ID,
-                    text=f"❌ फ़ाइल `{file_name}` को प्रोसेस करते समय एक गंभीर त्रुटि हुई: `{e}`",
-                    parse_mode="Markdown"
-                )
-        finally:
-            # Clean up the downloaded .txt file
-            if os.path.exists(local_txt_path):
-                os.remove(local_txt_path)
-                logger.info(f"Cleaned up {local_txt_path}")
-            # Remove cancellation event for this process
-            if chat_id in cancellation_events:
-                del cancellation_events[chat_id]
+            return
+
+        job_id = job_store.create_batch(file_name, initial_group_msg.message_id, 0, user.id)
+        job = Job(
+            job_id=job_id,
+            file_name=file_name,
+            status=StatusMessage(context.bot, GROUP_CHAT_ID, initial_group_msg.message_id, initial_group_msg_text),
+            user_id=user.id,
+            user_name=user.full_name,
+        )
+        active_jobs[job_id] = job
+
+        await update.message.reply_text(
+            f"फ़ाइल मिली: `{file_name}` (Job `#{job_id}`). लिंक्स प्रोसेस हो रहे हैं...\n"
+            f"रद्द करने के लिए: `/cancel {job_id}`",
+            parse_mode="Markdown"
+        )
+        # Run in the background so that the handler returns and /cancel, /jobs and new files are handled meanwhile.
+        # Plain asyncio task: Application.stop() waits for its own create_task() tasks, i.e. for whole batches.
+        job.task = asyncio.create_task(run_document_job(context, job, document.file_id, update.message))
     else:
         await update.message.reply_text("कृपया एक .txt फ़ाइल भेजें।")
 
-async def process_video_links(context: ContextTypes.DEFAULT_TYPE, txt_file_path: str, 
-                              initial_group_msg_id: int, cancellation_event: asyncio.Event) -> None:
-    """Reads the .txt file, parses links, downloads, and sends videos."""
-    with open(txt_file_path, 'r', encoding='utf-8') as f:
-        lines = [line.strip() for line in f if line.strip()] # Read and filter empty lines
+async def run_document_job(context: ContextTypes.DEFAULT_TYPE, job: Job, document_file_id: str,
+                           user_message: Message) -> None:
+    """Downloads the job's .txt file and processes all its links."""
+    # Create a 'downloads' directory if it doesn't exist
+    os.makedirs("downloads", exist_ok=True)
+    local_txt_path = os.path.join("downloads", f"{job.job_id}_{sanitize_filename(job.file_name)}")
 
-    total_videos = len(lines)
-    if total_videos == 0:
-        await context.bot.edit_message_text(
-            chat_id=GROUP_CHAT_ID,
-            message_id=initial_group_msg_id,
-            text=f"दिए गए फ़ाइल `{os.path.basename(txt_file_path)}` में कोई वैध वीडियो लिंक नहीं है।",
-            parse_mode="Markdown"
+    def reply(text):
+        # Notice queue se, taaki video errors ke baad hi pahunche
+        notice_sender.post(context.bot, text, chat_id=user_message.chat_id, reply_to_message_id=user_message.message_id)
+
+    try:
+        # Download the .txt file locally [3, 4, 25, 32, 35]
+        new_file = await context.bot.get_file(document_file_id)
+        await new_file.download_to_drive(local_txt_path)
+        logger.info(f"Downloaded {job.file_name} to {local_txt_path}")
+
+        await process_video_links(context, local_txt_path, job)
+
+        if not job.cancellation_event.is_set():
+            reply("✅ सभी वीडियो सफलतापूर्वक प्रोसेस हो गए हैं!")
+            job.status.set(f"🎉 `{job.file_name}` का प्रोसेसिंग पूरा हुआ! सभी वीडियो इस ग्रुप में भेज दिए गए हैं।")
+        else:
+            reply("⛔ वीडियो प्रोसेस रद्द कर दिया गया है।")
+            job.status.set(f"⛔ `{job.file_name}` का प्रोसेसिंग रद्द कर दिया गया है।")
+
+    except Exception as e:
+        logger.error(f"Error processing document {job.file_name}: {e}", exc_info=True)
+        job_store.finish_batch(job.job_id, "failed")
+        reply(f"❌ `{job.file_name}` को प्रोसेस करते समय एक त्रुटि हुई: `{e}`")
+        job.status.set(f"❌ `{job.file_name}` को प्रोसेस करते समय त्रुटि हुई: `{e}`")
+    finally:
+        await job.status.close() # Deliver the final text and stop the background editor
+        # Clean up the downloaded .txt file
+        if os.path.exists(local_txt_path):
+            os.remove(local_txt_path)
+            logger.info(f"Cleaned up {local_txt_path}")
+        active_jobs.pop(job.job_id, None)
+
+async def download_video(video_url: str, output_filepath: str, progress_callback,
+                         cancellation_event: asyncio.Event, yt_dlp_format: str = None) -> None:
+    """
+    Downloads a single video with the configured engine. Raises an exception on failure.
+    yt_dlp_format overrides YT_DLP_FORMAT (e.g. a bitrate cap from the pre-flight).
+    If the task is cancelled (/cancel), the engine stops its process and the partial files are removed
+    (kept when the bot is shutting down, so the resumed job continues from them).
+    """
+    try:
+        await download_video_with_engine(video_url, output_filepath, progress_callback, cancellation_event,
+                                         yt_dlp_format)
+    except asyncio.CancelledError:
+        if not shutting_down:
+            remove_partial_download(output_filepath)
+        raise
+
+async def download_video_with_engine(video_url: str, output_filepath: str, progress_callback,
+                                     cancellation_event: asyncio.Event, yt_dlp_format: str = None) -> None:
+    if DOWNLOAD_ENGINE == "hls":
+        try:
+            await download_video_with_hls(video_url, output_filepath, progress_callback, cancellation_event)
+            return
+        except asyncio.CancelledError:
+            raise
+        except httpx.HTTPError as e:
+            if is_transient_http_error(e):
+                # Origin abhi bhi down hai; yt-dlp bhi shuru se wahi fail karega. Line baad mein
+                # retry hogi aur native engine likhe hue segments ke aage se resume karega.
+                raise
+            logger.warning(f"Native HLS engine failed for {video_url}: {e}. yt-dlp par fallback kar rahe hain.")
+        except Exception as e:
+            logger.warning(f"Native HLS engine failed for {video_url}: {e}. yt-dlp par fallback kar rahe hain.")
+
+    if DOWNLOAD_ENGINE == "yt-dlp-api":
+        if yt_dlp is not None:
+            await download_video_with_yt_dlp_api(video_url, output_filepath, progress_callback, cancellation_event,
+                                                 yt_dlp_format)
+            return
+        logger.warning("yt_dlp Python package nahi mila, yt-dlp command use kar rahe hain.")
+
+    await download_video_with_yt_dlp(video_url, output_filepath, progress_callback, cancellation_event, yt_dlp_format)
+
+async def download_video_with_yt_dlp(video_url: str, output_filepath: str, progress_callback,
+                                     cancellation_event: asyncio.Event, format_spec: str = None) -> None:
+    """Downloads a single video with yt-dlp. Raises an exception on failure."""
+    command = [
+        "yt-dlp",
+        "--format", format_spec or YT_DLP_FORMAT,
+        "--output", output_filepath,
+        "--continue", # Pichhle attempt ki .part file / fragments se resume
+        "--retries", str(DOWNLOAD_RETRIES),
+        "--fragment-retries", str(DOWNLOAD_RETRIES),
+        "--retry-sleep", f"http:exp={RETRY_BACKOFF_BASE}:{RETRY_BACKOFF_MAX}",
+        "--retry-sleep", f"fragment:exp={RETRY_BACKOFF_BASE}:{RETRY_BACKOFF_MAX}",
+        "--abort-on-unavailable-fragments", # Chhoote segments wali toot-phooti video upload mat karo
+        "--restrict-filenames",
+        "--newline", # One progress line per update instead of carriage-return redraws
+        video_url
+    ]
+
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True # Own process group, so /cancel can stop yt-dlp together with its ffmpeg
+    )
+
+    # The readers own both pipes; calling communicate() as well would race them for the same data
+    stderr_tail = deque(maxlen=20)
+    try:
+        await asyncio.gather(
+            read_yt_dlp_output_for_progress(process.stdout, progress_callback, cancellation_event),
+            read_yt_dlp_output_for_progress(process.stderr, progress_callback, cancellation_event, stderr_tail),
         )
-        return
+        await process.wait() # Wait for yt-dlp to complete
+    except asyncio.CancelledError:
+        await terminate_process(process)
+        raise
 
-    for i, line in enumerate(lines):
-        if cancellation_event.is_set():
-            logger.info(f"Process cancelled after {i} videos.")
-            await context.bot.edit_message_text(
-                chat_id=GROUP_CHAT_ID,
-                message_id=initial_group_msg_id,
-                text=f"⛔ `{os.path.basename(txt_file_path)}` का प्रोसेसिंग रद्द कर दिया गया है। ({i}/{total_videos} वीडियो प्रोसेस हुए)",
-                parse_mode="Markdown"
-            )
-            break # Exit the loop if cancelled
+    if process.returncode != 0:
+        error_output = "\n".join(stderr_tail)
+        raise Exception(f"yt-dlp failed with code {process.returncode}: {error_output}")
 
-        video_num = i + 1
-        
-        # Regex to parse the line format: Title [Date Time]: URL
-        match = re.match(r"^(.*?)\s*\[\d{2}-\w{3}-\d{4}\s\d{2}:\d{2}\]:\s*(https?://.*\.m3u8)$", line)
+    logger.info(f"Successfully downloaded: {output_filepath}")
 
-        if not match:
-            await context.bot.send_message(
-                chat_id=GROUP_CHAT_ID,
-                text=f"⚠️ लाइन {video_num}/{total_videos} छोड़ दी गई है (`{os.path.basename(txt_file_path)}`):\n`{line}`\n"
-                     "अपेक्षित फ़ॉर्मेट: `Title [DD-Mon-YYYY HH:MM]: https://link.m3u8`",
-                parse_mode="Markdown"
-            )
-            continue
 
-        raw_title = match.group(1).strip()
-        video_url = match.group(2).strip()
+async def process_video_links(context: ContextTypes.DEFAULT_TYPE, txt_file_path: str, job: Job) -> None:
+    """
+    Reads the .txt file, parses links, downloads, and sends videos.
+
+    Download aur upload ek pipeline mein chalte hain: job ke DOWNLOAD_WORKERS videos ek saath download
+    hote hain, aur tayyar videos ek bounded queue se upload workers ke paas jaate hain. Group mein
+    videos hamesha file order mein hi post hote hain.
+    """
+    file_name = job.file_name
+    rejected_path = f"{txt_file_path}.rejected.txt"
+    report = parse_batch_file(txt_file_path, rejected_path)
+    total_videos = len(report.entries)
 
+    # One summary for the whole file (instead of one message per bad line) before any download starts
+    if report.invalid_count or report.duplicate_count:
+        summary = (f"📋 `{file_name}` की जाँच:\n"
+                   f"✅ {total_videos} वैध लिंक\n"
+                   f"❌ {report.invalid_count} अमान्य लाइनें\n"
+                   f"♻️ {report.duplicate_count} डुप्लिकेट लिंक\n"
+                   "अपेक्षित फ़ॉर्मेट: `Title [DD-Mon-YYYY HH:MM]: https://link.m3u8`")
+        try:
+            await send_batch_summary(context.bot, summary, rejected_path, f"rejected_{file_name}")
+        finally:
+            if os.path.exists(rejected_path):
+                os.remove(rejected_path)
+
+    job.total_videos = total_videos
+    job_store.set_batch_total(job.job_id, total_videos)
+    if total_videos == 0:
+        job_store.finish_batch(job.job_id, "done")
+        job.status.set(f"दिए गए फ़ाइल `{file_name}` में कोई वैध वीडियो लिंक नहीं है।")
+        return
+
+    batch_id = job.job_id
+    items = []
+    for video_num, (raw_title, video_url) in enumerate(report.entries, start=1):
         # Sanitize the title for filename
         clean_title_for_filename = re.sub(r'\s*\|\s*.*$', '', raw_title) # Remove " | Calculation (...)" part
         clean_title_for_filename = sanitize_filename(clean_title_for_filename) # [5, 9, 16, 21, 22]
-        output_filepath = os.path.join("downloads", f"{clean_title_for_filename}.mp4")
+        # Batch aur line number prefix taaki ek saath chal rahe downloads ek hi file par na likhein
+        output_filepath = os.path.join("downloads", f"{batch_id}_{video_num:04d}_{clean_title_for_filename}.mp4")
 
-        current_status_prefix = f"Processing video {video_num}/{total_videos}:\n`{raw_title}`"
-        
-        # Update main status message for current video
-        await context.bot.edit_message_text(
-            chat_id=GROUP_CHAT_ID,
-            message_id=initial_group_msg_id,
-            text=f"{current_status_prefix}\n⏳ डाउनलोड शुरू हो रहा है...",
-            parse_mode="Markdown"
-        )
+        items.append(VideoItem(seq=len(items), video_num=video_num, raw_title=raw_title,
+                               video_url=video_url, output_filepath=output_filepath))
+
+    job_store.add_lines(batch_id, items)
+    await run_video_pipeline(context, job, items)
+
+async def run_video_pipeline(context: ContextTypes.DEFAULT_TYPE, job: Job, items: list) -> None:
+    """
+    Downloads and sends the given items of a job, checkpointing every line in the job store.
+    Lines that fail are tried again at the end of the batch (BATCH_RETRY_PASSES times, resuming their
+    partial downloads) before they are reported as failed.
+    `job.processed` is the number of lines already finished (non-zero when resuming).
+    """
+    try:
+        retry_items = await run_pipeline_pass(context, job, items, final_pass=BATCH_RETRY_PASSES == 0)
+        for retry_pass in range(1, BATCH_RETRY_PASSES + 1):
+            if not retry_items or job.cancellation_event.is_set():
+                break
+            logger.info(f"Job {job.job_id}: {len(retry_items)} failed lines retry ho rahi hain "
+                        f"(pass {retry_pass}/{BATCH_RETRY_PASSES})")
+            job.status.set(f"🔁 Job `#{job.job_id}` — {len(retry_items)} असफल वीडियो की दोबारा कोशिश हो रही है...")
+            await asyncio.sleep(backoff_delay(retry_pass)) # Origin ko sambhalne ka thoda samay
+            job.processed -= len(retry_items)
+            for seq, item in enumerate(retry_items):
+                item.seq = seq # Is pass ka posting order
+            retry_items = await run_pipeline_pass(context, job, retry_items,
+                                                  final_pass=retry_pass == BATCH_RETRY_PASSES)
+    except BaseException:
+        for item in items: # Job fail/shutdown: retry ke liye rakhi files ab budget mein nahi ginni
+            await disk_budget.release(item.output_filepath)
+        raise
+
+    for item in retry_items: # Sirf cancel hone par bachte hain
+        remove_partial_download(item.output_filepath)
+        await disk_budget.release(item.output_filepath)
+
+    job_store.finish_batch(job.job_id, "cancelled" if job.cancellation_event.is_set() else "done")
+    if job.cancellation_event.is_set():
+        logger.info(f"Job {job.job_id} cancelled after {job.processed} videos.")
+        job.status.set(f"⛔ `{job.file_name}` का प्रोसेसिंग रद्द कर दिया गया है। "
+                       f"({job.processed}/{job.total_videos} वीडियो प्रोसेस हुए)")
 
+async def run_pipeline_pass(context: ContextTypes.DEFAULT_TYPE, job: Job, items: list, final_pass: bool) -> list:
+    """
+    One pass of the download -> upload pipeline over the given items (their seq must be 0..n-1).
+    Downloads and uploads take slots from the global pools, shared fairly with other users' jobs.
+    Unless this is the final pass, failed lines are not reported: they keep their partial downloads
+    and are returned so the caller can retry them.
+    """
+    batch_id = job.job_id
+    total_videos = job.total_videos
+    status = job.status
+    cancellation_event = job.cancellation_event
+
+    download_slots = asyncio.Semaphore(DOWNLOAD_WORKERS)
+    ready_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    posting_turn = PostingTurn()
+    stage_lines = {} # seq -> current status line of that video
+    retry_items = []
+
+    def refresh_status():
+        """Queues the state of all in-flight videos for the main group status message."""
+        text = f"Job `#{batch_id}` — कुल प्रगति: {job.processed}/{total_videos} वीडियो प्रोसेस हुए।"
+        for seq in sorted(stage_lines):
+            text += f"\n\n{stage_lines[seq]}"
+        status.set(text)
+
+    def make_progress_callback(item: VideoItem, status_prefix: str):
+        # Callback for progress updates
+        async def progress_callback(percent, speed, eta):
+            if cancellation_event.is_set(): # Stop updates if cancelled
+                return
+            progress_bar_str = create_progress_bar(percent)
+            extra_info = f" ({speed} - ETA: {eta})" if speed and eta else ""
+            stage_lines[item.seq] = f"{status_prefix}\n⬇️ डाउनलोड हो रहा है: {progress_bar_str}{extra_info}"
+            refresh_status()
+        return progress_callback
+
+    async def fetch_item(item: VideoItem, status_prefix: str, urgent: bool = False) -> bool:
+        """
+        Pre-flight, disk reservation, download under a global slot, post-processing and the size check.
+        urgent skips the disk queue: used when the item's turn to post has already come.
+        Returns False if it stopped because of cancellation.
+        """
+        if not urgent:
+            disk_budget.enqueue(item.output_filepath) # File order mein line lagao, pre-flight se pehle
         try:
-            # --- Download video using yt-dlp ---
-            logger.info(f"Attempting to download video {video_num}/{total_videos}: '{raw_title}' from {video_url}")
-            
-            command = [
-                "yt-dlp",
-                "--format", "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
-                "--output", output_filepath,
-                "--force-overwrites",
-                "--no-part",
-                "--restrict-filenames",
-                video_url
-            ]
-            
-            process = await asyncio.create_subprocess_exec(
-                *command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            if item.plan is None:
+                stage_lines[item.seq] = f"{status_prefix}\n🔍 क्वालिटी और साइज़ की जाँच हो रही है..."
+                refresh_status()
+                item.plan = await plan_download(item.video_url)
+
+            stage_lines[item.seq] = f"{status_prefix}\n💾 डिस्क पर जगह का इंतज़ार..."
+            refresh_status()
+            # Pre-flight ka andaza ho to wahi reserve karo, warna purana fixed estimate
+            await disk_budget.acquire(item.output_filepath,
+                                      item.plan.estimated_bytes or DISK_VIDEO_ESTIMATE_MB * 1024 * 1024,
+                                      urgent=urgent)
+        except BaseException:
+            # Pre-flight fail ya cancel: line mein jagah chhodo, warna peeche wali lines atak jayengi
+            await disk_budget.release(item.output_filepath)
+            raise
+        if cancellation_event.is_set():
+            return False
+
+        stage_lines[item.seq] = f"{status_prefix}\n🕒 डाउनलोड स्लॉट का इंतज़ार..."
+        refresh_status()
+        async with download_slot_pool.slot(job.user_key):
+            if cancellation_event.is_set():
+                return False
+            stage_lines[item.seq] = f"{status_prefix}\n⏳ डाउनलोड शुरू हो रहा है..."
+            refresh_status()
+
+            logger.info(f"Attempting to download video {item.video_num}/{total_videos}: "
+                        f"'{item.raw_title}' from {item.video_url}")
+            with track_stage("download", num_bytes=lambda: os.path.getsize(item.output_filepath)):
+                await download_video(item.plan.url, item.output_filepath,
+                                     make_progress_callback(item, status_prefix), cancellation_event,
+                                     item.plan.yt_dlp_format)
+        stage_lines[item.seq] = f"{status_prefix}\n🎞️ वीडियो की जाँच हो रही है..."
+        refresh_status()
+        await postprocess_video(item)
+        await fit_upload_limit(item)
+        job_store.set_line_state(batch_id, item.video_num, "downloaded")
+        item.state = "downloaded" # Upload fail ho to retry pass mein dobara download nahi hoga
+        return True
+
+    async def download_item(item: VideoItem) -> bool:
+        """Downloads one item. Returns False if it was skipped because of cancellation."""
+        async with download_slots:
+            if cancellation_event.is_set():
+                return False
+
+            status_prefix = f"Video {item.video_num}/{total_videos}:\n`{item.raw_title}`"
+            if file_id_cache:
+                item.cached_file_id = file_id_cache.lookup(f"url:{normalize_video_url(item.video_url)}")
+                if item.cached_file_id:
+                    logger.info(f"Video {item.video_num} file_id cache mein mila, download skip: {item.video_url}")
+                    stage_lines[item.seq] = f"{status_prefix}\n⚡ पहले भेजा जा चुका है, तुरंत दोबारा भेजा जाएगा..."
+                    return True
+
+            if item.state == "downloaded" and os.path.exists(item.output_filepath) \
+                    and os.path.getsize(item.output_filepath) > 0:
+                logger.info(f"Video {item.video_num} pehle hi download ho chuka tha, download skip: "
+                            f"{item.output_filepath}")
+                if item.metadata is None:
+                    await postprocess_video(item) # Restart ke baad metadata/thumbnail dobara banana padega
+                await fit_upload_limit(item)
+                stage_lines[item.seq] = f"{status_prefix}\n📦 डाउनलोड पूरा हुआ, अपलोड की बारी का इंतज़ार..."
+                return True
 
-            # Callback for progress updates
-            async def progress_callback(percent, speed, eta):
-                if cancellation_event.is_set(): # Stop updates if cancelled
-                    return
-                progress_bar_str = create_progress_bar(percent)
-                extra_info = f" ({speed} - ETA: {eta})" if speed and eta else ""
-                await context.bot.edit_message_text(
+            if not await fetch_item(item, status_prefix):
+                return False
+
+            if file_id_cache:
+                # Alag URL par same video ho sakta hai, content hash se upload bach jata hai
+                item.content_hash = await asyncio.to_thread(hash_file, item.output_filepath)
+                item.cached_file_id = file_id_cache.lookup(f"sha256:{item.content_hash}")
+
+            stage_lines[item.seq] = f"{status_prefix}\n📦 डाउनलोड पूरा हुआ, अपलोड की बारी का इंतज़ार..."
+            return True
+
+    async def producer():
+        """Starts downloads in file order; the bounded queue limits how far ahead they run."""
+        for item in items:
+            if cancellation_event.is_set():
+                logger.info(f"Process cancelled, no new downloads after video {item.video_num}.")
+                break
+            await ready_queue.put((item, job.track(asyncio.create_task(download_item(item)))))
+            QUEUE_DEPTH.inc(queue="ready")
+        # Cancel hone par (kisi worker ke fail hone se) workers bhi cancel hote hain, unhe signal nahi chahiye
+        for _ in range(UPLOAD_WORKERS):
+            await ready_queue.put(None)
+
+    async def upload_one(path, caption, metadata, thumbnail_path):
+        """Uploads one file under an upload slot, waiting out flood limits; feeds upload_throughput."""
+        async with upload_slot_pool.slot(job.user_key):
+            for flood_retry in range(UPLOAD_FLOOD_RETRIES + 1):
+                num_bytes = os.path.getsize(path)
+                started = time.monotonic()
+                try:
+                    with track_stage("upload", num_bytes=num_bytes):
+                        sent_message = await run_abortable(job, upload_video_file(
+                            context.bot,
+                            path,
+                            caption=caption,
+                            thumbnail_path=thumbnail_path,
+                            # Asli size/duration, taaki Telegram sahi aspect ratio aur length dikhaye
+                            **(metadata.send_video_params() if metadata else {})
+                        ))
+                    upload_throughput.update(num_bytes, time.monotonic() - started)
+                    return sent_message
+                except RetryAfter as e:
+                    TELEGRAM_RETRIES.inc(method="sendVideo")
+                    if flood_retry == UPLOAD_FLOOD_RETRIES:
+                        raise
+                    logger.warning(f"Upload of {path} flood-limited, retrying after {e.retry_after}s")
+                    await run_abortable(job, asyncio.sleep(e.retry_after))
+
+    async def repost_cached(item: VideoItem):
+        """Reposts the item by its cached file_id (no upload), waiting out flood limits like upload_one."""
+        for flood_retry in range(UPLOAD_FLOOD_RETRIES + 1):
+            try:
+                return await run_abortable(job, context.bot.send_video(
                     chat_id=GROUP_CHAT_ID,
-                    message_id=initial_group_msg_id,
-                    text=f"{current_status_prefix}\n⬇️ डाउनलोड हो रहा है: {progress_bar_str}{extra_info}",
+                    video=item.cached_file_id,
+                    caption=f"🎥 **{item.raw_title}**",
+                    supports_streaming=True,
                     parse_mode="Markdown"
+                ))
+            except RetryAfter as e:
+                TELEGRAM_RETRIES.inc(method="sendVideo")
+                if flood_retry == UPLOAD_FLOOD_RETRIES:
+                    raise
+                logger.warning(f"Repost of video {item.video_num} flood-limited, retrying after {e.retry_after}s")
+                await run_abortable(job, asyncio.sleep(e.retry_after))
+
+    async def upload_worker():
+        while True:
+            entry = await ready_queue.get()
+            if entry is None:
+                break
+            QUEUE_DEPTH.dec(queue="ready")
+            item, download_task = entry
+            status_prefix = f"Video {item.video_num}/{total_videos}:\n`{item.raw_title}`"
+            line_finished = False
+            retry_later = False
+            try:
+                await asyncio.wait([download_task])
+                await posting_turn.wait(item.seq)
+
+                if download_task.cancelled() or (download_task.exception() is None and not download_task.result()) \
+                        or cancellation_event.is_set():
+                    logger.info(f"Video {item.video_num} processing cancelled: {item.raw_title}")
+                    VIDEOS_PROCESSED.inc(result="cancelled")
+                    continue
+
+                if download_task.exception() is not None:
+                    raise download_task.exception()
+
+                # --- Repost from file_id cache (no upload) ---
+                if item.cached_file_id:
+                    try:
+                        await repost_cached(item)
+                        logger.info(f"Reposted video {item.video_num} from file_id cache")
+                        VIDEOS_PROCESSED.inc(result="cached")
+                        job_store.set_line_state(batch_id, item.video_num, "uploaded")
+                        line_finished = True
+                        # Content hash se mila ho to is naye URL ko bhi yaad rakho, agli baar download hi na ho
+                        file_id_cache.store([f"url:{normalize_video_url(item.video_url)}"], item.cached_file_id)
+                        continue
+                    except BadRequest as e:
+                        logger.warning(f"Cached file_id for video {item.video_num} is no longer valid ({e}), "
+                                       "uploading again.")
+                        file_id_cache.forget(item.cached_file_id)
+                        item.cached_file_id = None
+
+                if not os.path.exists(item.output_filepath):
+                    # Cache hit ki wajah se download skip hua tha, lekin file_id kaam nahi kiya. Baaki
+                    # downloads ki tarah slot, disk budget aur /cancel ke saath; posting ki baari isi ki hai,
+                    # isliye disk queue mein sabse aage
+                    if not await run_abortable(job, fetch_item(item, status_prefix, urgent=True)):
+                        raise JobCancelledError("Cancelled before the re-download")
+
+                # --- Send video to Telegram group ---
+                stage_lines[item.seq] = f"{status_prefix}\n⬆️ डाउनलोड पूरा हुआ। वीडियो अपलोड हो रहा है..."
+                refresh_status()
+
+                if os.path.exists(item.output_filepath) and os.path.getsize(item.output_filepath) > 0:
+                    if item.parts:
+                        # Stream-copy split same file ke same parts deta hai, to pichle pass/restart mein
+                        # gaye parts count se skip ho jaate hain
+                        for part_num, part in enumerate(item.parts, start=1):
+                            if part_num <= item.parts_uploaded:
+                                continue
+                            await upload_one(part.path, f"🎥 **{item.raw_title}** (भाग {part_num}/{len(item.parts)})",
+                                             part.metadata, part.thumbnail_path)
+                            item.parts_uploaded = part_num
+                            job_store.set_parts_uploaded(batch_id, item.video_num, part_num)
+                        logger.info(f"Sent video in {len(item.parts)} parts: {item.output_filepath}")
+                    else:
+                        sent_message = await upload_one(item.output_filepath, f"🎥 **{item.raw_title}**",
+                                                        item.metadata, item.thumbnail_path)
+                        logger.info(f"Sent video: {item.output_filepath}")
+                    VIDEOS_PROCESSED.inc(result="uploaded")
+                    job_store.set_line_state(batch_id, item.video_num, "uploaded")
+                    line_finished = True
+                    if file_id_cache and not item.parts: # Tukdon ka ek file_id nahi hota
+                        sent_media = sent_message.video or sent_message.document
+                        cache_keys = [f"url:{normalize_video_url(item.video_url)}"]
+                        if item.content_hash:
+                            cache_keys.append(f"sha256:{item.content_hash}")
+                        if sent_media:
+                            file_id_cache.store(cache_keys, sent_media.file_id)
+                else:
+                    raise FileNotFoundError(f"डाउनलोड की गई फ़ाइल नहीं मिली या खाली है: {item.output_filepath}")
+
+            except JobCancelledError:
+                logger.info(f"Video {item.video_num} upload aborted by /cancel: {item.raw_title}")
+                VIDEOS_PROCESSED.inc(result="cancelled")
+            except Exception as e:
+                line_finished = True
+                if not final_pass and not isinstance(e, VideoTooLargeError): # Size retry se nahi ghatega
+                    # Batch ke end mein dobara try hoga; adhura download disk par rehta hai taaki wahin se resume ho
+                    logger.warning(f"Video '{item.raw_title}' failed, batch ke end mein retry hoga: {e}")
+                    job_store.set_line_state(batch_id, item.video_num, item.state, str(e))
+                    VIDEOS_PROCESSED.inc(result="retry")
+                    retry_items.append(item)
+                    retry_later = True
+                    continue
+                logger.error(f"Error processing video '{item.raw_title}': {e}", exc_info=True)
+                job_store.set_line_state(batch_id, item.video_num, "failed", str(e))
+                VIDEOS_PROCESSED.inc(result="failed")
+                notice_sender.post( # Send new message for error rather than editing main status for clarity
+                    context.bot,
+                    f"❌ वीडियो {item.video_num}/{total_videos} (`{item.raw_title}`) को प्रोसेस करते समय त्रुटि हुई:\n`{e}`"
                 )
+            finally:
+                stage_lines.pop(item.seq, None)
+                if not download_task.done():
+                    download_task.cancel()
+                job.processed += 1
+                await posting_turn.advance()
+                # Clean up the downloaded video file (and any partial download). Agar bot band ho raha hai
+                # (line adhuri hai) ya line retry hogi, to files rehne do taaki dobara download na karna pade.
+                if retry_later and not cancellation_event.is_set():
+                    # Rakhi gayi files disk budget mein gini jaati hain; cap se upar ho to hata do
+                    if not await disk_budget.retain(item.output_filepath):
+                        logger.info(f"Retry ke liye rakha data DISK_RETRY_KEEP_MB se zyada, "
+                                    f"video {item.video_num} shuru se download hoga")
+                        remove_partial_download(item.output_filepath)
+                        item.parts = None
+                else:
+                    if (line_finished and not retry_later) or cancellation_event.is_set():
+                        remove_partial_download(item.output_filepath)
+                    await disk_budget.release(item.output_filepath)
+                if line_finished and not cancellation_event.is_set():
+                    refresh_status()
 
-            stderr_reader_task = asyncio.create_task(
-                read_yt_dlp_stderr_for_progress(process.stderr, progress_callback, cancellation_event)
+    tasks = [asyncio.create_task(producer()), *(asyncio.create_task(upload_worker()) for _ in range(UPLOAD_WORKERS))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Ek task fail hua to baaki ko bhi roko, warna downloads bina upload worker ke chalte rahenge
+        for task in [*tasks, *job.inflight_tasks]:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return retry_items
+
+async def resume_unfinished_batches(application: Application) -> None:
+    """Resumes jobs that were still running when the bot last stopped. Uploaded lines are skipped."""
+    for batch in job_store.unfinished_batches():
+        if not job_store.has_lines(batch["id"]):
+            # Bot .txt file padhne se pehle hi band ho gaya tha: resume karne ko kuch nahi, aur "done" kehna jhooth hoga
+            logger.warning(f"Job {batch['id']} ({batch['file_name']}) has no lines, marking it failed")
+            job_store.finish_batch(batch["id"], "failed")
+            notice_sender.post(
+                application.bot,
+                f"❌ Bot restart हुआ, `{batch['file_name']}` की लिंक्स पढ़ने से पहले ही। कृपया फ़ाइल दोबारा भेजें।"
             )
+            continue
+        items = job_store.pending_items(batch["id"])
+        job = Job(
+            job_id=batch["id"],
+            file_name=batch["file_name"],
+            status=StatusMessage(application.bot, GROUP_CHAT_ID, batch["status_msg_id"]),
+            user_id=batch["user_id"],
+            total_videos=batch["total_videos"],
+            # Lines already uploaded or failed count as processed
+            processed=batch["total_videos"] - len(items),
+        )
+        active_jobs[job.job_id] = job
+        logger.info(f"Resuming job {job.job_id} ({job.file_name}): {len(items)} lines pending")
+        job.task = asyncio.create_task(run_resumed_job(application, job, items))
+
+async def run_resumed_job(application: Application, job: Job, items: list) -> None:
+    """Runs the remaining lines of a job that was interrupted by a restart."""
+    try:
+        notice_sender.post(
+            application.bot,
+            f"♻️ Bot restart हुआ। Job `#{job.job_id}` (`{job.file_name}`) का प्रोसेसिंग फिर से शुरू हो रहा है "
+            f"({job.processed}/{job.total_videos} पहले ही प्रोसेस हो चुके हैं)।"
+        )
+        await run_video_pipeline(application, job, items)
+        if not job.cancellation_event.is_set():
+            job.status.set(f"🎉 `{job.file_name}` का प्रोसेसिंग पूरा हुआ! सभी वीडियो इस ग्रुप में भेज दिए गए हैं।")
+    except Exception as e:
+        logger.error(f"Error resuming job {job.job_id} ({job.file_name}): {e}", exc_info=True)
+        job_store.finish_batch(job.job_id, "failed")
+        notice_sender.post(application.bot, f"❌ `{job.file_name}` को फिर से शुरू करते समय त्रुटि हुई: `{e}`")
+    finally:
+        await job.status.close()
+        active_jobs.pop(job.job_id, None)
+
+async def start_background_jobs(application: Application) -> None:
+    """post_init hook: opens the upload bot, prunes old job records and resumes unfinished batches."""
+    if upload_bot is not None:
+        await upload_bot.initialize()
+    job_store.prune_finished(JOB_STORE_RETENTION_DAYS * 24 * 3600)
+    application.create_task(resume_unfinished_batches(application))
+
+async def stop_active_jobs(application: Application) -> None:
+    """
+    Called before Application.stop() (webhook) / as post_stop (polling): cancels the running jobs so a
+    redeploy doesn't wait for whole batches. Their batches stay 'running' in the job store with the
+    downloaded files kept, and resume on the next start.
+    """
+    global shutting_down
+    shutting_down = True
+    tasks = [job.task for job in active_jobs.values() if job.task and not job.task.done()]
+    if tasks:
+        logger.info(f"Shutdown: {len(tasks)} running jobs roke ja rahe hain, restart ke baad resume honge")
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks, timeout=JOB_STOP_TIMEOUT) # Render SIGTERM ke baad sirf kuch seconds deta hai
+    await notice_sender.drain(timeout=JOB_STOP_TIMEOUT)
 
-            stdout, _ = await process.communicate() # Wait for yt-dlp to complete
+# --- Webhook Server ---
 
-            # Ensure the stderr reader task is cancelled after main process completes
-            stderr_reader_task.cancel()
+if tornado is not None:
+    class TelegramWebhookHandler(tornado.web.RequestHandler):
+        """Receives updates from Telegram and hands them to the application."""
+        def initialize(self, bot_application):
+            self.bot_application = bot_application
+
+        async def post(self):
             try:
-                await stderr_reader_task # Wait for the task to finish cleaning up
-            except asyncio.CancelledError:
-                logger.info("Stderr reader task cancelled successfully.")
-
-            if process.returncode != 0:
-                error_output = stderr.decode(errors='ignore')
-                raise Exception(f"yt-dlp failed with code {process.returncode}: {error_output}")
-            
-            logger.info(f"Successfully downloaded: {output_filepath}")
-            
-            # --- Send video to Telegram group ---
-            if cancellation_event.is_set(): # Check cancellation again before sending
-                raise asyncio.CancelledError("Video sending cancelled by user.")
-
-            await context.bot.edit_message_text(
-                chat_id=GROUP_CHAT_ID,
-                message_id=initial_group_msg_id,
-                text=f"{current_status_prefix}\n⬆️ डाउनलोड पूरा हुआ। वीडियो अपलोड हो रहा है...",
-                parse_mode="Markdown"
-            )
+                update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+            except ValueError as e:
+                logger.warning(f"Invalid webhook payload: {e}")
+                raise tornado.web.HTTPError(400)
+            await self.bot_application.update_queue.put(update)
 
-            if os.path.exists(output_filepath) and os.path.getsize(output_filepath) > 0:
-                with open(output_filepath, 'rb') as video_file:
-                    await context.bot.send_video(
-                        chat_id=GROUP_CHAT_ID,
-                        video=video_file,
-                        caption=f"🎥 **{raw_title}**",
-                        supports_streaming=True,
-                        read_timeout=1200,
-                        write_timeout=1200,
-                        width=1280, # Optional: Specify common video dimensions
-                        height=720,
-                        parse_mode="Markdown"
-                    )
-                logger.info(f"Sent video: {output_filepath}")
-                # Update status in group to indicate completion for this video
-                await context.bot.edit_message_text(
-                    chat_id=GROUP_CHAT_ID,
-                    message_id=initial_group_msg_id,
-                    text=f"✅ {current_status_prefix}\nवीडियो सफलतापूर्वक भेजा गया!",
-                    parse_mode="Markdown"
-                )
-            else:
-                raise FileNotFoundError(f"डाउनलोड की गई फ़ाइल नहीं मिली या खाली है: {output_filepath}")
+    class MetricsHandler(tornado.web.RequestHandler):
+        """Serves the metrics in the Prometheus text format."""
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write(render_metrics())
 
-        except asyncio.CancelledError:
-            logger.info(f"Video {video_num} processing cancelled: {raw_title}")
-            await context.bot.send_message(
-                chat_id=GROUP_CHAT_ID,
-                text=f"⛔ वीडियो {video_num}/{total_videos} (`{raw_title}`) का प्रोसेसिंग रद्द कर दिया गया।",
-                parse_mode="Markdown"
-            )
-            # Revert main status message to indicate overall progress
-            await context.bot.edit_message_text(
-                chat_id=GROUP_CHAT_ID,
-                message_id=initial_group_msg_id,
-                text=f"कुल प्रगति: {video_num-1}/{total_videos} वीडियो प्रोसेस हुए। अगला वीडियो रद्द किया गया।",
-                parse_mode="Markdown"
-            )
-            # Break the loop since the overall process is cancelled
-            break
+def run_webhook_with_metrics(application: Application, port: int, webhook_url: str) -> None:
+    """
+    Like Application.run_webhook, but our own web server also serves /metrics on the same port
+    (python-telegram-bot's built-in webhook server can't host extra paths, and Render exposes only PORT).
+    """
+    async def serve():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stop_signal, stop_event.set)
 
-        except Exception as e:
-            logger.error(f"Error processing video '{raw_title}': {e}", exc_info=True)
-            await context.bot.send_message( # Send new message for error rather than editing main status for clarity
-                chat_id=GROUP_CHAT_ID,
-                text=f"❌ वीडियो {video_num}/{total_videos} (`{raw_title}`) को प्रोसेस करते समय त्रुटि हुई:\n`{e}`",
-                parse_mode="Markdown"
-            )
-            # Revert main status message to indicate overall progress (if it's not the last video)
-            if video_num < total_videos:
-                await context.bot.edit_message_text(
-                    chat_id=GROUP_CHAT_ID,
-                    message_id=initial_group_msg_id,
-                    text=f"कुल प्रगति: {video_num}/{total_videos} वीडियो प्रोसेस हुए। अगले वीडियो के साथ जारी है...",
-                    parse_mode="Markdown"
-                )
-        finally:
-            # Clean up the downloaded video file
-            if os.path.exists(output_filepath):
-                os.remove(output_filepath)
-                logger.info(f"Cleaned up {output_filepath}")
+        web_app = tornado.web.Application([
+            (rf"/{re.escape(TELEGRAM_BOT_TOKEN)}/?", TelegramWebhookHandler, {"bot_application": application}),
+            (r"/metrics", MetricsHandler),
+        ])
+        server = web_app.listen(port, address="0.0.0.0") # Sabhi available interfaces par suno
+
+        async with application: # initialize() ... shutdown()
+            if application.post_init:
+                await application.post_init(application)
+            await application.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES)
+            await application.start()
+            await stop_event.wait()
+            server.stop()
+            await stop_active_jobs(application)
+            await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    asyncio.run(serve())
 
 # --- Main Bot Setup ---
 
@@ -378,13 +2617,32 @@ def main() -> None:
         logger.error("GROUP_CHAT_ID environment variable set nahi hai. Exit ho raha hai.")
         exit(1)
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    global job_store, file_id_cache, upload_bot
+    job_store = JobStore(JOB_DB_PATH)
+    if FILE_ID_CACHE_MAX_ENTRIES > 0:
+        file_id_cache = FileIdCache(JOB_DB_PATH, FILE_ID_CACHE_MAX_ENTRIES, FILE_ID_CACHE_MAX_AGE_DAYS * 24 * 3600)
+
+    upload_bot = build_upload_bot(TELEGRAM_BOT_TOKEN, LOCAL_BOT_API_URL)
+    if LOCAL_BOT_API_URL:
+        logger.info(f"Uploads local Bot API server par jayenge: {LOCAL_BOT_API_URL} "
+                    f"(limit {UPLOAD_SIZE_LIMIT_MB} MB, local mode {BOT_API_LOCAL_MODE})")
+
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(build_control_request())
+        .post_init(start_background_jobs)
+        .post_stop(stop_active_jobs)
+        .post_shutdown(close_http_client)
+        .build()
+    )
 
     port = int(os.environ.get("PORT", "8443"))
 
     # Command handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CommandHandler("jobs", jobs_command))
 
     # Message handlers: listens for any document, then checks if it's text/plain
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
@@ -393,12 +2651,14 @@ def main() -> None:
     WEBHOOK_URL = os.getenv("WEBHOOK_URL") 
     
     if WEBHOOK_URL:
-        logger.info(f"Webhook par chal raha hai: {WEBHOOK_URL} port {port} par")
-        application.run_webhook(
-            listen="0.0.0.0", # Sabhi available interfaces par suno
-            port=port,
-            url_path=TELEGRAM_BOT_TOKEN, # Telegram ko URL path mein token chahiye webhooks ke liye
-            webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_BOT_TOKEN}"
+        logger.info(f"Webhook par chal raha hai: {WEBHOOK_URL} port {port} par (metrics: /metrics)")
+        if tornado is None:
+            logger.error("tornado install nahi hai. `pip install python-telegram-bot[webhooks]` karein. Exit ho raha hai.")
+            exit(1)
+        run_webhook_with_metrics(
+            application,
+            port,
+            webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_BOT_TOKEN}" # Telegram ko URL path mein token chahiye webhooks ke liye
         )
     else:
         logger.error("WEBHOOK_URL environment variable set nahi hai. Webhook nahi chal sakta. "
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# main.py repo root mein hai, package nahi
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,83 @@
+"""Batch .txt grammar, duplicate detection and URL normalization."""
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("line, title, date, url", [
+    ("Lecture 1 [08-Apr-2024 08:30]: https://cdn.example.com/a.m3u8",
+     "Lecture 1", "08-Apr-2024 08:30", "https://cdn.example.com/a.m3u8"),
+    ("Lecture 2 [8-Apr-2024]: https://cdn.example.com/b.mp4", "Lecture 2", "8-Apr-2024", "https://cdn.example.com/b.mp4"),
+    ("Lecture 3: http://cdn.example.com/c.m3u8", "Lecture 3", None, "http://cdn.example.com/c.m3u8"),
+    ("Ratio 1:2 revision: https://cdn.example.com/d.m3u8", "Ratio 1:2 revision", None, "https://cdn.example.com/d.m3u8"),
+    ("https://cdn.example.com/e.m3u8?token=abc", None, None, "https://cdn.example.com/e.m3u8?token=abc"),
+])
+def test_line_pattern_accepts(line, title, date, url):
+    match = main.BATCH_LINE_PATTERN.match(line)
+    assert match
+    assert match.group("title") == title
+    assert match.group("date") == date
+    assert match.group("url") == url
+
+
+@pytest.mark.parametrize("line", [
+    "Lecture 1 [08-Apr-2024]",
+    "Lecture 1: ftp://cdn.example.com/a.m3u8",
+    "Lecture 1: https://cdn.example.com/a b.m3u8",
+    "just some notes",
+])
+def test_line_pattern_rejects(line):
+    assert not main.BATCH_LINE_PATTERN.match(line)
+
+
+def test_parse_batch_file(tmp_path):
+    txt_path = tmp_path / "batch.txt"
+    txt_path.write_text(
+        "Intro [08-Apr-2024 08:30]: https://cdn.example.com/intro.m3u8?token=1\n"
+        "\n"
+        "https://cdn.example.com/videos/chapter-2.mp4\n"
+        "not a link\n"
+        "Intro again: https://CDN.example.com/intro.m3u8?token=2#t=10\n"
+        "Chapter 3: https://cdn.example.com/chapter-3.m3u8\n",
+        encoding="utf-8"
+    )
+    rejected_path = str(tmp_path / "rejected.txt")
+
+    report = main.parse_batch_file(str(txt_path), rejected_path)
+
+    assert report.entries == [
+        ("Intro", "https://cdn.example.com/intro.m3u8?token=1"),
+        ("chapter-2", "https://cdn.example.com/videos/chapter-2.mp4"), # Bare URL: title file name se
+        ("Chapter 3", "https://cdn.example.com/chapter-3.m3u8"),
+    ]
+    assert report.invalid_count == 1
+    assert report.duplicate_count == 1
+    assert report.rejected_path == rejected_path
+    with open(rejected_path, encoding="utf-8") as f:
+        assert f.read().splitlines() == [
+            "Line 4 (invalid format): not a link",
+            "Line 5 (duplicate of line 1): Intro again: https://CDN.example.com/intro.m3u8?token=2#t=10",
+        ]
+
+
+def test_parse_batch_file_without_rejects(tmp_path):
+    txt_path = tmp_path / "batch.txt"
+    txt_path.write_text("A: https://cdn.example.com/a.m3u8\n", encoding="utf-8")
+    rejected_path = tmp_path / "rejected.txt"
+
+    report = main.parse_batch_file(str(txt_path), str(rejected_path))
+
+    assert report.entries == [("A", "https://cdn.example.com/a.m3u8")]
+    assert report.rejected_path is None
+    assert not rejected_path.exists()
+
+
+def test_normalize_video_url():
+    assert main.normalize_video_url(" HTTPS://CDN.Example.com:443/v/a.m3u8?b=2&token=x&a=1&Expires=9#frag ") \
+        == "https://cdn.example.com/v/a.m3u8?a=1&b=2"
+    assert main.normalize_video_url("http://cdn.example.com:8080/a.m3u8") == "http://cdn.example.com:8080/a.m3u8"
+    # Path case aur non-signing params alag videos hain
+    assert main.normalize_video_url("https://cdn.example.com/A.m3u8") \
+        != main.normalize_video_url("https://cdn.example.com/a.m3u8")
+    assert main.normalize_video_url("https://cdn.example.com/a.m3u8?id=1") \
+        != main.normalize_video_url("https://cdn.example.com/a.m3u8?id=2")
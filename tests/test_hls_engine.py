@@ -0,0 +1,138 @@
+"""Native HLS engine against a synthetic playlist served from a local HTTP server."""
+import asyncio
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main
+
+SEGMENTS = [bytes([i]) * (1000 + i) for i in range(5)]
+
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=400000,RESOLUTION=640x360
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=1200000,AVERAGE-BANDWIDTH=1000000,RESOLUTION=1280x720
+high/index.m3u8
+"""
+
+MEDIA_PLAYLIST = "#EXTM3U\n#EXT-X-TARGETDURATION:4\n" + "".join(
+    f"#EXTINF:4.0,\n{i}.ts\n" for i in range(len(SEGMENTS))
+) + "#EXT-X-ENDLIST\n"
+
+ENCRYPTED_PLAYLIST = MEDIA_PLAYLIST.replace("#EXT-X-TARGETDURATION:4\n",
+                                            '#EXT-X-TARGETDURATION:4\n#EXT-X-KEY:METHOD=AES-128,URI="key.bin"\n')
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        OriginHandler.requests.append(self.path)
+        if self.path == "/master.m3u8":
+            body = MASTER_PLAYLIST.encode()
+        elif self.path.endswith("/index.m3u8"):
+            body = (ENCRYPTED_PLAYLIST if self.path.startswith("/secure/") else MEDIA_PLAYLIST).encode()
+        elif self.path == "/secure/master.m3u8":
+            body = MASTER_PLAYLIST.encode()
+        elif self.path.startswith("/high/") and self.path.endswith(".ts"):
+            body = SEGMENTS[int(self.path.rsplit("/", 1)[1][:-3])]
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origin(monkeypatch):
+    OriginHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(main, "http_client", None) # Har test ka apna event loop, isliye naya client
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def run_download(url, output_filepath):
+    progress = []
+
+    async def progress_callback(percent, speed, eta):
+        progress.append(percent)
+
+    async def go():
+        try:
+            await main.download_video_with_hls(url, output_filepath, progress_callback, asyncio.Event())
+        finally:
+            await main.close_http_client(None)
+
+    asyncio.run(go())
+    return progress
+
+
+def test_parse_master_playlist():
+    playlist = main.parse_hls_playlist(MASTER_PLAYLIST, "http://origin/v/master.m3u8")
+    assert [variant.url for variant in playlist.variants] == ["http://origin/v/low/index.m3u8",
+                                                              "http://origin/v/high/index.m3u8"]
+    assert playlist.variants[1].average_bandwidth == 1000000
+    assert main.select_hls_variant(playlist.variants).resolution == "1280x720"
+
+
+def test_parse_media_playlist():
+    playlist = main.parse_hls_playlist(MEDIA_PLAYLIST, "http://origin/v/high/index.m3u8")
+    assert playlist.segment_urls[0] == "http://origin/v/high/0.ts"
+    assert sum(playlist.segment_durations) == 20.0
+    assert not playlist.variants
+
+
+def test_download_from_local_server(origin, tmp_path, monkeypatch):
+    # Remux ffmpeg ka kaam hai; yahan sirf segments ka order aur resume files check karte hain
+    async def copy_remux(input_path, output_path):
+        shutil.copyfile(input_path, output_path)
+    monkeypatch.setattr(main, "remux_to_mp4", copy_remux)
+    monkeypatch.setattr(main.shutil, "which", lambda name: f"/usr/bin/{name}")
+
+    output_filepath = str(tmp_path / "video.mp4")
+    progress = run_download(f"{origin}/master.m3u8", output_filepath)
+
+    with open(output_filepath, "rb") as f:
+        assert f.read() == b"".join(SEGMENTS)
+    assert progress[-1] == 100.0
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["video.mp4"] # .segments aur .json hat gaye
+
+
+def test_missing_ffmpeg_fails_before_fetching(origin, tmp_path, monkeypatch):
+    monkeypatch.setattr(main.shutil, "which", lambda name: None)
+    with pytest.raises(main.HlsUnsupportedError):
+        run_download(f"{origin}/master.m3u8", str(tmp_path / "video.mp4"))
+    assert OriginHandler.requests == []
+
+
+def test_encrypted_playlist_is_strict_only():
+    with pytest.raises(main.HlsUnsupportedError):
+        main.parse_hls_playlist(ENCRYPTED_PLAYLIST, "http://origin/v/high/index.m3u8")
+    playlist = main.parse_hls_playlist(ENCRYPTED_PLAYLIST, "http://origin/v/high/index.m3u8", strict=False)
+    assert sum(playlist.segment_durations) == 20.0
+
+
+def test_preflight_plans_encrypted_stream(origin, monkeypatch):
+    # 20s: high variant ~2.5 MB, low ~1 MB; limit 2 MB par low chuna jana chahiye
+    monkeypatch.setattr(main, "UPLOAD_SIZE_LIMIT_MB", 2)
+
+    async def go():
+        try:
+            return await main.plan_download(f"{origin}/secure/master.m3u8")
+        finally:
+            await main.close_http_client(None)
+
+    plan = asyncio.run(go())
+    assert plan.url == f"{origin}/secure/low/index.m3u8"
+    assert plan.estimated_bytes == 400000 // 8 * 20
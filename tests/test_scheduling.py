@@ -0,0 +1,113 @@
+"""FairSlots round-robin between users and DiskBudget grant order."""
+import asyncio
+
+import pytest
+
+import main
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_fair_slots_round_robin():
+    async def go():
+        pool = main.FairSlots("test", 1)
+        order = []
+
+        async def use(user_key, name):
+            async with pool.slot(user_key):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        await pool.acquire("holder")
+        tasks = [asyncio.create_task(use("a", name)) for name in ("a1", "a2", "a3")]
+        await settle()
+        tasks.append(asyncio.create_task(use("b", "b1")))
+        await settle()
+        pool.release()
+        await asyncio.gather(*tasks)
+        assert pool.in_use == 0
+        return order
+
+    # "a" ne pehle 3 lines queue ki, phir bhi "b" ko doosra slot milta hai
+    assert asyncio.run(go()) == ["a1", "b1", "a2", "a3"]
+
+
+def test_fair_slots_cancelled_waiter_is_skipped():
+    async def go():
+        pool = main.FairSlots("test", 1)
+        await pool.acquire("holder")
+        cancelled = asyncio.create_task(pool.acquire("a"))
+        waiting = asyncio.create_task(pool.acquire("b"))
+        await settle()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        pool.release()
+        await asyncio.wait_for(waiting, timeout=1)
+        assert pool.in_use == 1
+        assert not pool._waiters
+
+    asyncio.run(go())
+
+
+def test_disk_budget_grants_in_queue_order(tmp_path):
+    async def go():
+        budget = main.DiskBudget(str(tmp_path), 100, 0, 0)
+        order = []
+
+        async def acquire(name, num_bytes):
+            await budget.acquire(str(tmp_path / name), num_bytes)
+            order.append(name)
+
+        await budget.acquire(str(tmp_path / "a"), 60)
+        budget.enqueue(str(tmp_path / "b"))
+        budget.enqueue(str(tmp_path / "c"))
+        # "c" fit ho jaata, par "b" line mein aage hai aur use jagah ka intezaar hai
+        small = asyncio.create_task(acquire("c", 10))
+        big = asyncio.create_task(acquire("b", 60))
+        await settle()
+        assert order == []
+        await budget.release(str(tmp_path / "a"))
+        await asyncio.wait_for(asyncio.gather(small, big), timeout=1)
+        return order
+
+    assert asyncio.run(go()) == ["b", "c"]
+
+
+def test_disk_budget_release_while_queued_cancels_waiter(tmp_path):
+    async def go():
+        budget = main.DiskBudget(str(tmp_path), 100, 0, 0)
+        await budget.acquire(str(tmp_path / "a"), 90)
+        waiter = asyncio.create_task(budget.acquire(str(tmp_path / "b"), 50))
+        await settle()
+        await budget.release(str(tmp_path / "b"))
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(waiter, timeout=1)
+
+    asyncio.run(go())
+
+
+def test_disk_budget_counts_retained_partials(tmp_path):
+    async def go():
+        budget = main.DiskBudget(str(tmp_path), 100, 0, 50)
+        kept, dropped = str(tmp_path / "kept.mp4"), str(tmp_path / "dropped.mp4")
+        await budget.acquire(kept, 40)
+        await budget.acquire(dropped, 40)
+        (tmp_path / "kept.mp4.part").write_bytes(b"x" * 30)
+        (tmp_path / "dropped.mp4.part").write_bytes(b"x" * 30)
+        assert await budget.retain(kept)
+        assert not await budget.retain(dropped) # 60 bytes retry_keep_bytes se zyada
+
+        await budget.acquire(str(tmp_path / "other"), 60)
+        blocked = asyncio.create_task(budget.acquire(str(tmp_path / "next"), 20))
+        await settle()
+        assert not blocked.done() # 60 reserved + 30 retained + 20 > 100
+        await budget.acquire(kept, 40, urgent=True) # Retry pass: retained ab reservation mein
+        assert budget._retained == {}
+        await budget.release(kept)
+        await asyncio.wait_for(blocked, timeout=1)
+
+    asyncio.run(go())